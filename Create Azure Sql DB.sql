@@ -27,9 +27,63 @@ CREATE TABLE standard_values (
   value_avg REAL,
   value_min REAL,
   value_max REAL,
-  source_val NVARCHAR(500)
+  source_val NVARCHAR(500),
+  -- Natural key of a standard value (besides kpi_id) as SHA-256, because the text
+  -- columns together exceed SQL Server's 1700-byte index key limit. Texts are
+  -- upper-cased and right-trimmed as the case-insensitive collation compares them
+  -- in the MERGE upsert; NULL and empty text stay distinct.
+  key_hash AS CAST(HASHBYTES('SHA2_256', CONCAT(
+    ISNULL(N'1' + UPPER(RTRIM(geographical_loc)), N'0'), NCHAR(31),
+    ISNULL(N'1' + UPPER(RTRIM(country)), N'0'), NCHAR(31),
+    ISNULL(N'1' + UPPER(RTRIM(industry)), N'0'), NCHAR(31),
+    ISNULL(N'1' + UPPER(RTRIM(gender)), N'0'), NCHAR(31),
+    ISNULL(N'1' + UPPER(RTRIM(age_group)), N'0'), NCHAR(31),
+    ISNULL(N'1' + UPPER(RTRIM(experience_level)), N'0'), NCHAR(31),
+    ISNULL(N'1' + UPPER(RTRIM(source_val)), N'0')
+  )) AS BINARY(32)) PERSISTED
 )
 
+CREATE INDEX ix_kpis_category_maincat_id ON kpis_category (maincat_id)
+
+-- Natural keys used by the upserts in insert_to_db; they also serve the lookups of
+-- kpis by category_id and standard_values by kpi_id.
+-- On an existing database run "python app.py compact" before creating them.
+CREATE UNIQUE INDEX ux_kpis_category_name ON kpis_category (cat_name, maincat_id)
+CREATE UNIQUE INDEX ux_kpis_category_id_name ON kpis (category_id, kpi_name)
+-- source_val is part of the standard value key so figures of different years or
+-- sources stay apart; the text columns are indexed through key_hash.
+CREATE UNIQUE INDEX ux_standard_values_key ON standard_values (kpi_id, key_hash)
+
+-- Filters of /show_data, paged by standard_val_id
+CREATE INDEX ix_standard_values_country ON standard_values (country, standard_val_id)
+CREATE INDEX ix_standard_values_industry ON standard_values (industry, standard_val_id)
+CREATE INDEX ix_standard_values_gender ON standard_values (gender, standard_val_id)
+
+-- Revisions: page fingerprints of stored documents and the standard values
+-- extracted from each page, so re-uploads only re-extract changed pages
+CREATE TABLE documents (
+  document_id INT IDENTITY(1,1) PRIMARY KEY,
+  document_name NVARCHAR(255),
+  file_hash NVARCHAR(64)
+)
+CREATE UNIQUE INDEX ux_documents_name ON documents (document_name)
+
+CREATE TABLE document_pages (
+  document_id INT,
+  page_number INT,
+  fingerprint NVARCHAR(64),
+  PRIMARY KEY (document_id, page_number)
+)
+
+CREATE TABLE document_rows (
+  document_id INT,
+  page_number INT,
+  standard_val_id INT,
+  -- Pages of the extraction (chunk or table) the link came from, e.g. "1,2"
+  source_pages NVARCHAR(255),
+  PRIMARY KEY (document_id, page_number, standard_val_id, source_pages)
+)
+CREATE INDEX ix_document_rows_standard_val_id ON document_rows (standard_val_id)
 
 CREATE TABLE main_category (
   maincat_id int IDENTITY(1,1) PRIMARY KEY,
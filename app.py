@@ -1,14 +1,34 @@
 import os
+import time
+import argparse
+import asyncio
+import re
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field, asdict
+from operator import attrgetter
 import aiohttp
 import aiofiles
 import mimetypes
 import json
+import hashlib
+import sqlite3
+import uuid
+import random
+import math
+import email.utils
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AzureOpenAI, APIConnectionError
 from azure.storage.blob import BlobServiceClient
-from quart import Quart, render_template, request, redirect, url_for
+from quart import Quart, Response, render_template, request, redirect, url_for, jsonify
+from werkzeug.utils import secure_filename
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.ai.documentintelligence.models import AnalyzeResult
 
 #db
 import urllib
@@ -16,7 +36,9 @@ from sqlalchemy import text
 from dotenv import load_dotenv
 import sqlalchemy as db
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool
 
 # Kor!
 from kor.extraction import create_extraction_chain
@@ -29,6 +51,19 @@ from langchain.llms import OpenAI
 from langchain.chat_models import AzureChatOpenAI
 from langchain_community.chat_models import AzureChatOpenAI
 from langchain_community.llms import OpenAI
+from langchain_community.callbacks import get_openai_callback
+
+# Optional exact token counting
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Optional PDF page counting; page-range analysis is off without it
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
 
 
 load_dotenv()
@@ -36,609 +71,2356 @@ load_dotenv()
 # Configure folder for uploaded files
 app = Quart(__name__)
 app.config['UPLOAD_FOLDER'] = 'data/'
+# Larger request bodies are rejected with 413 before they are parsed
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+upload_chunk_size = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# /show_data paging
+show_data_page_size = int(os.getenv("SHOW_DATA_PAGE_SIZE", "100"))
+show_data_max_page_size = int(os.getenv("SHOW_DATA_MAX_PAGE_SIZE", "1000"))
+# Rendered /show_data pages; SHOW_DATA_CACHE_DIR shares them between workers.
+# The data generation is always shared through DATA_GENERATION_PATH, so writes
+# by ingest.py or "python app.py compact" invalidate the server's pages too.
+show_data_cache_size = int(os.getenv("SHOW_DATA_CACHE_SIZE", "256"))
+show_data_cache_dir = os.getenv("SHOW_DATA_CACHE_DIR", "")
+data_generation_path = os.getenv(
+    "DATA_GENERATION_PATH", os.path.join(show_data_cache_dir or "cache", "generation")
+)
+show_data_cache_max_bytes = int(os.getenv("SHOW_DATA_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# Rows fetched per server-side cursor batch by the /api endpoints
+api_batch_size = int(os.getenv("API_BATCH_SIZE", "1000"))
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Azure Blob Storage Configuration
-azure_storage_connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-container_name = os.getenv("CONTAINER_NAME")
+# Background job queue: "memory", or "sqlite" to persist jobs in JOB_DB_PATH
+job_queue_backend = os.getenv("JOB_QUEUE_BACKEND", "memory")
+job_db_path = os.getenv("JOB_DB_PATH", "cache/jobs.db")
+# Finished jobs kept in memory by the memory backend, oldest evicted first
+job_history_size = int(os.getenv("JOB_HISTORY_SIZE", "1000"))
+# Workers sharing a SQLite job queue lease their jobs for JOB_LEASE_SECONDS and
+# renew the lease every third of it; other workers resume a job once it expired
+job_lease_seconds = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+job_stage_workers = {
+    "analyze": int(os.getenv("ANALYZE_WORKERS", "2")),
+    "extract": int(os.getenv("EXTRACT_WORKERS", "4")),
+    "store": int(os.getenv("STORE_WORKERS", "2")),
+}
+
+# Observability: prefix log lines with a per-request/per-job trace id, and the
+# latency histogram buckets (seconds) exposed on /metrics
+trace_ids_enabled = os.getenv("TRACE_IDS", "false").lower() in ("1", "true", "yes")
+metrics_buckets = [
+    float(bucket) for bucket in os.getenv("METRICS_BUCKETS", "0.01,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120").split(",")
+]
+
+# Azure Blob Storage Configuration
+azure_storage_connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+container_name = os.getenv("CONTAINER_NAME")
+
+# Azure Document Intelligence
+key = os.getenv("DOCUMENTINTELLIGENCE_API_KEY")
+endpoint = os.getenv("DOCUMENTINTELLIGENCE_ENDPOINT")
+documentintelligence_concurrency = int(os.getenv("DOCUMENTINTELLIGENCE_CONCURRENCY", "4"))
+documentintelligence_polling_interval = float(os.getenv("DOCUMENTINTELLIGENCE_POLLING_INTERVAL", "1"))
+documentintelligence_model = "prebuilt-layout"
+# PDFs with more pages than DI_PAGE_RANGE_SIZE are analysed as concurrent page
+# ranges of that size (0 disables), at most DI_RANGE_FAN_OUT at a time per document
+di_page_range_size = int(os.getenv("DI_PAGE_RANGE_SIZE", "0"))
+di_range_fan_out = int(os.getenv("DI_RANGE_FAN_OUT", "4"))
+
+# Document Intelligence result cache (empty DI_CACHE_DIR disables it)
+di_cache_dir = os.getenv("DI_CACHE_DIR", "cache/documentintelligence")
+di_cache_max_bytes = int(os.getenv("DI_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+di_cache_ttl = int(os.getenv("DI_CACHE_TTL", str(7 * 24 * 3600)))
+
+# LLM extraction result cache (empty LLM_CACHE_DIR disables it)
+llm_cache_dir = os.getenv("LLM_CACHE_DIR", "cache/extraction")
+llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+llm_cache_ttl = int(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))
+
+# Azure OpenAI Configuration
+openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+openai_api_key = os.getenv("AZURE_OPENAI_API_KEY")
+deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+openai_model_name = "gpt-4"
+llm_concurrency = int(os.getenv("LLM_CONCURRENCY", "8"))
+chunk_max_tokens = int(os.getenv("CHUNK_MAX_TOKENS", "3000"))
+extraction_fan_out = int(os.getenv("EXTRACTION_FAN_OUT", "4"))
+
+# Page pre-filter: pages scoring below PAGE_MIN_SCORE (numbers, %/currency,
+# tables, category keywords) are not sent to the LLM; PAGE_TOP_K caps the
+# number of pages kept per document (0 = no cap). PAGE_FILTER=false sends all pages.
+page_filter_enabled = os.getenv("PAGE_FILTER", "true").lower() in ("1", "true", "yes")
+page_min_score = float(os.getenv("PAGE_MIN_SCORE", "3"))
+page_top_k = int(os.getenv("PAGE_TOP_K", "0"))
+
+# Revisions: an upload naming a stored document (the optional "document" form
+# field) only sends the pages whose content fingerprint changed to the LLM. INCREMENTAL_EXTRACTION=false
+# re-extracts every page (the document's rows are still replaced, not added to).
+incremental_extraction = os.getenv("INCREMENTAL_EXTRACTION", "true").lower() in ("1", "true", "yes")
+
+# Few-shot examples for the Kor schema: "all", "relevant" (best KOR_EXAMPLES_MAX
+# examples by word overlap with the text) or "none"
+kor_examples_path = os.getenv("KOR_EXAMPLES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "kpi_examples.json"))
+kor_examples_mode = os.getenv("KOR_EXAMPLES_MODE", "all")
+kor_examples_max = int(os.getenv("KOR_EXAMPLES_MAX", "1"))
+kor_example_min_score = float(os.getenv("KOR_EXAMPLE_MIN_SCORE", "0.2"))
+
+# CATEGORY_EXTRACTION=true extracts each selected main category with its own
+# focused schema and stores the results only under that category; chunks with
+# fewer than CATEGORY_MIN_KEYWORDS of a category's keywords skip its extraction
+# (0 = none skip). The focused schema only changes the description, so prompts
+# keep their size and a chunk costs up to one call per selected category. The
+# default runs one generic extraction stored under every selected category.
+category_extraction = os.getenv("CATEGORY_EXTRACTION", "false").lower() in ("1", "true", "yes")
+category_min_keywords = int(os.getenv("CATEGORY_MIN_KEYWORDS", "1"))
+
+# Throttling: requests/tokens per minute admitted per worker (0 = unlimited) and
+# retries of throttled or transient failures. The concurrency settings above are
+# the upper bound of the adaptive limits, which halve on 429s and grow back slowly.
+documentintelligence_rpm = int(os.getenv("DOCUMENTINTELLIGENCE_RPM", "0"))
+llm_rpm = int(os.getenv("LLM_RPM", "0"))
+llm_tpm = int(os.getenv("LLM_TPM", "0"))
+llm_completion_tokens = int(os.getenv("LLM_COMPLETION_TOKENS", "1000"))
+retry_max_attempts = int(os.getenv("RETRY_MAX_ATTEMPTS", "6"))
+retry_base_delay = float(os.getenv("RETRY_BASE_DELAY", "1"))
+retry_max_delay = float(os.getenv("RETRY_MAX_DELAY", "60"))
+
+#db configuration
+driver_name = os.getenv("DRIVER_NAME")
+server_name = os.getenv("SERVER_NAME")
+database_name = os.getenv("DATABASE_NAME")
+username = os.getenv("USERNAME_1")
+password = os.getenv("PASSWORD")
+
+# Create connection string
+connection_string = (
+    f'Driver={driver_name};'
+    f'Server=tcp:{server_name}.database.windows.net,1433;'
+    f'Database={database_name};'
+    f'Uid={username};'
+    f'Pwd={password};'
+    'Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
+)
+
+# db connection pool configuration
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "5"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+db_pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+db_pool_pre_ping = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Initialize Blob Service Client
+#blob_service_client = BlobServiceClient.from_connection_string(azure_storage_connection_string)
+#container_client = blob_service_client.get_container_client(container_name)
+
+# Table definitions (mirror Create Azure Sql DB.sql), used by the bulk write path
+metadata = db.MetaData()
+
+main_category_table = db.Table(
+    "main_category", metadata,
+    db.Column("maincat_id", db.Integer, primary_key=True),
+    db.Column("main_category_name", db.Unicode(50)),
+)
+
+kpis_category_table = db.Table(
+    "kpis_category", metadata,
+    db.Column("cat_id", db.Integer, primary_key=True),
+    db.Column("cat_name", db.Unicode(50)),
+    db.Column("cat_description", db.Unicode(200)),
+    db.Column("maincat_id", db.Integer),
+    db.Index("ix_kpis_category_maincat_id", "maincat_id"),
+    db.Index("ux_kpis_category_name", "cat_name", "maincat_id", unique=True),
+)
+
+kpis_table = db.Table(
+    "kpis", metadata,
+    db.Column("kpi_id", db.Integer, primary_key=True),
+    db.Column("category_id", db.Integer),
+    db.Column("kpi_name", db.Unicode(200)),
+    db.Column("unit", db.Unicode(50)),
+    db.Column("kpi_source", db.Unicode(500)),
+    db.Column("kpi_description", db.Unicode(500)),
+    db.Index("ux_kpis_category_id_name", "category_id", "kpi_name", unique=True),
+)
+
+standard_values_table = db.Table(
+    "standard_values", metadata,
+    db.Column("standard_val_id", db.Integer, primary_key=True),
+    db.Column("kpi_id", db.Integer),
+    db.Column("geographical_loc", db.Unicode(100)),
+    db.Column("country", db.Unicode(100)),
+    db.Column("industry", db.Unicode(100)),
+    db.Column("gender", db.Unicode(50)),
+    db.Column("age_group", db.Unicode(50)),
+    db.Column("experience_level", db.Unicode(50)),
+    db.Column("value_avg", db.Float),
+    db.Column("value_min", db.Float),
+    db.Column("value_max", db.Float),
+    db.Column("source_val", db.Unicode(500)),
+    # On SQL Server the text columns are indexed through a SHA-256 column instead
+    # (1700-byte index key limit), see "Create Azure Sql DB.sql"
+    db.Index(
+        "ux_standard_values_key",
+        "kpi_id", "geographical_loc", "country", "industry", "gender", "age_group", "experience_level",
+        "source_val", unique=True
+    ),
+    db.Index("ix_standard_values_country", "country", "standard_val_id"),
+    db.Index("ix_standard_values_industry", "industry", "standard_val_id"),
+    db.Index("ix_standard_values_gender", "gender", "standard_val_id"),
+)
+
+# Stored documents, the content fingerprint of each of their pages and the
+# standard values extracted from each page, used to re-extract only the
+# changed pages of a revision. source_pages ("1,2") identifies the extraction
+# a link came from, so a multi-page chunk is dropped as a whole.
+documents_table = db.Table(
+    "documents", metadata,
+    db.Column("document_id", db.Integer, primary_key=True),
+    db.Column("document_name", db.Unicode(255)),
+    db.Column("file_hash", db.Unicode(64)),
+    db.Index("ux_documents_name", "document_name", unique=True),
+)
+
+document_pages_table = db.Table(
+    "document_pages", metadata,
+    db.Column("document_id", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("page_number", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("fingerprint", db.Unicode(64)),
+)
+
+document_rows_table = db.Table(
+    "document_rows", metadata,
+    db.Column("document_id", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("page_number", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("standard_val_id", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("source_pages", db.Unicode(255), primary_key=True),
+    db.Index("ix_document_rows_standard_val_id", "standard_val_id"),
+)
+
+# Map category names to their database IDs
+category_mapping = {
+    'Demographic': 1,
+    'Performance Data': 2,
+    'Leave Policies': 3,
+    'Salary Information': 4
+}
+
+# Trace id of the current request or job, see log()
+current_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+def log(*args):
+    """print() with the current trace id prefixed when one is set"""
+    trace_id = current_trace_id.get()
+    if trace_id:
+        print(f"[{trace_id}]", *args)
+    else:
+        print(*args)
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in the Prometheus text format by /metrics"""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, description):
+        self.descriptions[name] = (kind, description)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @staticmethod
+    def format_sample(name, labels, value):
+        if labels:
+            escaped = [(label, str(label_value).replace("\\", "\\\\").replace('"', '\\"')) for label, label_value in labels]
+            name = name + "{" + ",".join(f'{label}="{label_value}"' for label, label_value in escaped) + "}"
+        return f"{name} {value}"
+
+    def render(self, gauges=()):
+        """
+        Render all metrics
+
+        Args:
+            gauges (list): (name, labels dict, value) samples computed at scrape time
+        Returns:
+            str: Prometheus text exposition format
+        """
+        with self.lock:
+            samples = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.setdefault(name, []).append(self.format_sample(name, labels, value))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(self.format_sample(f"{name}_bucket", labels + (("le", f"{bound:g}"),), count))
+                lines.append(self.format_sample(f"{name}_bucket", labels + (("le", "+Inf"),), histogram["count"]))
+                lines.append(self.format_sample(f"{name}_sum", labels, histogram["sum"]))
+                lines.append(self.format_sample(f"{name}_count", labels, histogram["count"]))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append(self.format_sample(name, tuple(sorted(labels.items())), value))
+
+        output = []
+        for name in sorted(samples):
+            if name in self.descriptions:
+                kind, description = self.descriptions[name]
+                output.append(f"# HELP {name} {description}")
+                output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+metrics = Metrics(metrics_buckets)
+metrics.describe("stage_duration_seconds", "histogram", "Time spent in each processing stage")
+metrics.describe("job_stage_duration_seconds", "histogram", "Time a background job spent in each pipeline stage")
+metrics.describe("http_request_duration_seconds", "histogram", "Request latency per endpoint")
+metrics.describe("document_pages_analyzed_total", "counter", "Pages returned by Document Intelligence or its cache")
+metrics.describe("llm_tokens_total", "counter", "Tokens sent to and received from the LLM")
+metrics.describe("pages_filtered_total", "counter", "Pages kept for or dropped before extraction by the pre-filter")
+metrics.describe("pages_unchanged_total", "counter", "Pages of revised documents skipped because their fingerprint did not change")
+metrics.describe("tables_total", "counter", "Layout tables mapped directly to rows or sent to the LLM as markdown")
+metrics.describe("extraction_chunks_total", "counter", "Chunks sent to or skipped by the extraction of each main category")
+metrics.describe("llm_example_tokens_total", "counter", "Estimated prompt tokens spent on few-shot examples")
+metrics.describe("db_rows_upserted_total", "counter", "Rows written by insert_to_db")
+metrics.describe("db_round_trips_total", "counter", "Statements sent to the database")
+metrics.describe("db_pool_checked_out", "gauge", "Connections currently checked out of the pool")
+metrics.describe("db_pool_overflow", "gauge", "Overflow connections currently open")
+metrics.describe("job_queue_depth", "gauge", "Jobs waiting per pipeline stage")
+
+@contextmanager
+def time_stage(stage):
+    """Record the duration of the enclosed block in stage_duration_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", elapsed, stage=stage)
+        if current_trace_id.get():
+            log(f"{stage} took {elapsed:.3f}s")
+
+def count_round_trip(conn, cursor, statement, parameters, context, executemany):
+    metrics.inc("db_round_trips_total")
+
+metrics.describe("service_retries_total", "counter", "Retried calls per service and HTTP status")
+metrics.describe("service_concurrency_limit", "gauge", "Current adaptive concurrency limit per service")
+
+retryable_statuses = {408, 429, 500, 502, 503, 504}
+
+def error_status(error):
+    """HTTP status of an Azure SDK or OpenAI error, or None"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+def retry_after_seconds(error):
+    """Delay requested by the service through retry-after-ms or Retry-After (seconds or HTTP date)"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        if headers.get(name):
+            try:
+                return float(headers[name]) / 1000
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+def is_retryable(error):
+    """Throttling, server errors and connection failures are worth retrying"""
+    if isinstance(error, (ServiceRequestError, ServiceResponseError, APIConnectionError,
+                          aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    return error_status(error) in retryable_statuses
+
+def retry_delay(error, attempt):
+    """Retry-After (spread by up to half of it) if the service sent one, otherwise jittered exponential backoff"""
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after * random.uniform(1.0, 1.5), retry_max_delay)
+    return min(retry_max_delay, retry_base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+class TokenBucket:
+    """Admits up to rate_per_minute units per minute, with bursts of at most one minute's worth"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.available = float(rate_per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        # Requests larger than the bucket would never fit, they wait for a full bucket instead
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit adjusted by AIMD
+
+    The limit grows by one after a limit's worth of successful calls and is
+    halved when the service throttles. Throttled calls admitted before the
+    last decrease are ignored, so one burst of 429s halves the limit once.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.decreased = 0.0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def succeeded(self):
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.successes = 0
+            self.limit = min(self.maximum, self.limit + 1)
+
+    def throttled(self, admitted):
+        if admitted >= self.decreased:
+            self.decreased = time.monotonic()
+            self.successes = 0
+            self.limit = max(self.minimum, self.limit // 2)
+
+class RateLimitedService:
+    """
+    Shared admission control and retry policy for one Azure service
+
+    Each attempt waits for the requests/tokens per minute buckets and a slot
+    of the adaptive concurrency limit. Throttled and transient failures are
+    retried with exponential backoff, honouring Retry-After.
+    """
+
+    def __init__(self, name, max_concurrency, rpm=0, tpm=0):
+        self.name = name
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    async def call(self, func, tokens=0):
+        """
+        Run func() under the service limits
+
+        Args:
+            func: Coroutine function performing one attempt of the call
+            tokens (int): Tokens the call is expected to consume, for the TPM bucket
+        Returns:
+            The result of func()
+        """
+        attempt = 1
+        while True:
+            if self.requests:
+                await self.requests.acquire()
+            if self.tokens and tokens:
+                await self.tokens.acquire(tokens)
+            async with self.limiter:
+                admitted = time.monotonic()
+                try:
+                    result = await func()
+                except Exception as e:
+                    status = error_status(e)
+                    if status == 429:
+                        self.limiter.throttled(admitted)
+                    if attempt >= retry_max_attempts or not is_retryable(e):
+                        raise
+                    reason = str(status or type(e).__name__)
+                    delay = retry_delay(e, attempt)
+                else:
+                    self.limiter.succeeded()
+                    return result
+            metrics.inc("service_retries_total", service=self.name, status=reason)
+            log(f"{self.name}: attempt {attempt} failed ({reason}), "
+                f"retrying in {delay:.1f}s with concurrency {self.limiter.limit}")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        return {"concurrency_limit": self.limiter.limit, "in_flight": self.limiter.in_flight}
+
+# Process-wide engine, created in before_serving and disposed in after_serving
+engine = None
+
+# Pool checkout counters, see get_pool_stats()
+pool_stats = {"checkouts": 0, "checkout_wait_total": 0.0, "checkout_wait_max": 0.0, "connects": 0}
+pool_stats_lock = threading.Lock()
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with pool_stats_lock:
+                pool_stats["checkouts"] += 1
+                pool_stats["checkout_wait_total"] += waited
+                pool_stats["checkout_wait_max"] = max(pool_stats["checkout_wait_max"], waited)
+
+def count_pool_connect(dbapi_connection, connection_record):
+    with pool_stats_lock:
+        pool_stats["connects"] += 1
+
+def create_db_engine():
+    """
+    Create the pooled SQLAlchemy engine
+
+    DATABASE_URL (e.g. sqlite:///kpis.db) overrides Azure SQL for local runs and benchmarks.
+    In-memory SQLite keeps SQLAlchemy's default pool, as every pooled connection
+    would otherwise see its own empty database.
+    """
+    database_url = os.getenv("DATABASE_URL")
+    if database_url and database_url in ("sqlite://", "sqlite:///:memory:"):
+        new_engine = db.create_engine(database_url)
+        db.event.listen(new_engine, "before_cursor_execute", count_round_trip)
+        return new_engine
+
+    pool_options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": db_pool_size,
+        "max_overflow": db_max_overflow,
+        "pool_timeout": db_pool_timeout,
+        "pool_recycle": db_pool_recycle,
+        "pool_pre_ping": db_pool_pre_ping,
+    }
+    if database_url:
+        new_engine = db.create_engine(database_url, **pool_options)
+    else:
+        params = urllib.parse.quote(connection_string)
+        url = f"mssql+pyodbc:///?odbc_connect={params}"
+        new_engine = db.create_engine(url, fast_executemany=True, **pool_options)
+    db.event.listen(new_engine, "connect", count_pool_connect)
+    db.event.listen(new_engine, "before_cursor_execute", count_round_trip)
+    return new_engine
+
+def get_engine():
+    """Return the shared engine, creating it on first use outside the Quart app (scripts, benchmarks)"""
+    global engine
+    if engine is None:
+        engine = create_db_engine()
+    return engine
+
+def get_pool_stats():
+    """
+    Current connection pool usage
+
+    Returns:
+        dict: pool size, checked in/out and overflow connections plus checkout wait times
+    """
+    stats = {"size": None, "checked_in": None, "checked_out": None, "overflow": None}
+    if engine is not None and isinstance(engine.pool, QueuePool):
+        stats.update(
+            size=engine.pool.size(),
+            checked_in=engine.pool.checkedin(),
+            checked_out=engine.pool.checkedout(),
+            overflow=engine.pool.overflow(),
+        )
+    with pool_stats_lock:
+        stats.update(pool_stats)
+    stats["checkout_wait_avg"] = (
+        stats["checkout_wait_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    )
+    return stats
+
+class DiskCache:
+    """
+    Size-bounded JSON cache on local disk
+
+    Entries expire after `ttl` seconds and the least recently used entries
+    are evicted once the directory grows beyond `max_bytes`. Entry access
+    time is tracked through the file modification time.
+    """
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if time.time() - entry["created"] > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry["value"]
+
+    def put(self, key, value):
+        """Store a JSON-serialisable value and evict old entries if needed"""
+        if not self.directory:
+            return
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"created": time.time(), "value": value}, f)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under max_bytes"""
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self.remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self.lock:
+            self.evictions += 1
+
+    def clear(self):
+        """Remove every entry"""
+        if not self.directory:
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                os.remove(entry.path)
+
+    def stats(self):
+        with self.lock:
+            return {"enabled": bool(self.directory), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# Layout results keyed by file content, so re-uploads skip the Azure call
+document_cache = DiskCache(di_cache_dir, di_cache_max_bytes, di_cache_ttl)
+
+# Shared async Document Intelligence client and its limits; retries are left to document_service
+document_client = None
+document_service = RateLimitedService("document_intelligence", documentintelligence_concurrency, documentintelligence_rpm)
+
+def get_document_client():
+    """Return the shared async Document Intelligence client, creating it on first use"""
+    global document_client
+    if document_client is None:
+        document_client = DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key), retry_total=0)
+    return document_client
+
+@app.before_serving
+async def startup():
+    """Create process-wide resources once per worker"""
+    global engine, document_client, extraction_llm
+    engine = create_db_engine()
+    document_client = DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key), retry_total=0)
+    if extraction_llm is None:
+        extraction_llm = build_extraction_llm()
+    await start_job_workers()
+
+@app.after_serving
+async def shutdown():
+    """Release process-wide resources"""
+    global engine, document_client
+    await stop_job_workers()
+    if engine is not None:
+        engine.dispose()
+        engine = None
+    if document_client is not None:
+        await document_client.close()
+        document_client = None
+
+number_prefix = re.compile(r"^(?:AUD|USD|EUR|GBP|[$€£])+", re.IGNORECASE)
+# One comma followed by one or two digits at the end ("12,5", "1.234,56") is a decimal comma
+decimal_comma = re.compile(r"[\d.]*\d,\d{1,2}")
+
+def parse_number(value):
+    """
+    Number in an extracted value or table cell ("12.3%", "$1,200", "AUD 5", "(4.5)", "-$5", "12,5"), or None
+
+    Missing values ("", "N/A", ...) and anything else that is not a finite
+    number give None. Other commas are thousands separators.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+        return number if math.isfinite(number) else None
+    text = str(value).strip().replace(" ", "")
+    negative = text.startswith("(") and text.endswith(")")
+    text = text.strip("()")
+    # A sign before the currency symbol ("-$5")
+    if text[:1] in ("-", "+") and text[1:2] not in ("-", "+"):
+        negative = negative != (text[0] == "-")
+        text = text[1:]
+    text = number_prefix.sub("", text).rstrip("%")
+    if decimal_comma.fullmatch(text):
+        text = text.replace(".", "").replace(",", ".")
+    else:
+        text = text.replace(",", "")
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    if not math.isfinite(number):
+        return None
+    return -number if negative else number
+
+# Version of the stored KPI data, changed on every committed insert. The
+# per-process token keeps ETags from before a restart from matching.
+data_generation = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+
+def get_data_generation():
+    """Current data generation, shared through DATA_GENERATION_PATH once any process wrote data"""
+    try:
+        with open(data_generation_path) as f:
+            return f.read().strip() or data_generation
+    except OSError:
+        return data_generation
+
+def bump_data_generation():
+    """Invalidate cached /show_data pages after the data changed"""
+    global data_generation
+    data_generation = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+    # A unique token rather than a read-modify-write counter, so concurrent writers cannot collide
+    if os.path.dirname(data_generation_path):
+        os.makedirs(os.path.dirname(data_generation_path), exist_ok=True)
+    temp_path = f"{data_generation_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(data_generation)
+    os.replace(temp_path, data_generation_path)
+
+# Natural keys used to deduplicate rows across uploads
+category_key_columns = ("cat_name", "maincat_id")
+kpi_key_columns = ("category_id", "kpi_name")
+standard_value_key_columns = (
+    "kpi_id", "geographical_loc", "country", "industry", "gender", "age_group", "experience_level",
+    "source_val"
+)
+document_row_key_columns = ("document_id", "page_number", "standard_val_id", "source_pages")
+
+# SQL Server accepts at most 2100 parameters per statement
+mssql_max_parameters = 2000
+
+def merge_rows(session, table, columns, rows, key_columns, id_column=None):
+    """
+    Upsert rows on SQL Server with one MERGE per batch
+
+    Rows are matched on key_columns (NULL-safe); matches get their other
+    columns updated, the rest are inserted. The source row ordinal is
+    returned through OUTPUT so identities map back to the input rows even
+    when the collation matches keys case-insensitively.
+    """
+    update_columns = [column for column in columns if column not in key_columns]
+    key_indexes = [columns.index(column) for column in key_columns]
+    dialect = session.get_bind().dialect
+    types = {column: table.c[column].type.compile(dialect=dialect) for column in columns}
+    batch_size = max(1, mssql_max_parameters // (len(columns) + 1))
+
+    ids = {}
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        params = {}
+        values = []
+        for ordinal, row in enumerate(batch):
+            params[f"o{ordinal}"] = ordinal
+            placeholders = [f":o{ordinal}"]
+            for index, column in enumerate(columns):
+                params[f"p{ordinal}_{index}"] = row[index]
+                placeholders.append(f"CAST(:p{ordinal}_{index} AS {types[column]})")
+            values.append(f"({', '.join(placeholders)})")
+
+        match = " AND ".join(
+            f"(target.{column} = source.{column} OR (target.{column} IS NULL AND source.{column} IS NULL))"
+            for column in key_columns
+        )
+        statement = (
+            f"MERGE INTO {table.name} WITH (HOLDLOCK) AS target "
+            f"USING (VALUES {', '.join(values)}) AS source (ordinal, {', '.join(columns)}) "
+            f"ON {match} "
+        )
+        if update_columns:
+            statement += (
+                "WHEN MATCHED THEN UPDATE SET "
+                + ", ".join(f"target.{column} = source.{column}" for column in update_columns) + " "
+            )
+        statement += (
+            f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) "
+            f"VALUES ({', '.join(f'source.{column}' for column in columns)})"
+        )
+        statement += f" OUTPUT source.ordinal, INSERTED.{id_column};" if id_column else ";"
+
+        result = session.execute(text(statement), params)
+        if id_column:
+            for ordinal, row_id in result:
+                ids[tuple(batch[ordinal][index] for index in key_indexes)] = row_id
+    return ids
+
+def update_or_insert_rows(session, table, columns, rows, key_columns, id_column=None):
+    """
+    Upsert rows on SQLite with one UPDATE and one INSERT ... WHERE NOT EXISTS executemany
+
+    Keys are compared with the NULL-safe IS operator. The row tuples go to
+    the driver as positional parameters, without per-row dicts.
+    """
+    update_columns = [column for column in columns if column not in key_columns]
+    key_indexes = [columns.index(column) for column in key_columns]
+    update_indexes = [columns.index(column) for column in update_columns]
+    match = " AND ".join(f"{column} IS ?" for column in key_columns)
+    connection = session.connection()
+
+    if update_columns:
+        connection.exec_driver_sql(
+            f"UPDATE {table.name} SET " + ", ".join(f"{column} = ?" for column in update_columns) + f" WHERE {match}",
+            [tuple(row[index] for index in update_indexes + key_indexes) for row in rows]
+        )
+    connection.exec_driver_sql(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"SELECT {', '.join('?' for _ in columns)} "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {table.name} WHERE {match})",
+        [row + tuple(row[index] for index in key_indexes) for row in rows]
+    )
+
+    if not id_column:
+        return {}
+    # Select candidates by the first key column and match the whole key in
+    # Python, where None == None (a tuple IN never matches NULL columns)
+    keys = {tuple(row[index] for index in key_indexes) for row in rows}
+    first_values = sorted({key[0] for key in keys if key[0] is not None})
+    ids = {}
+    for start in range(0, len(first_values), 500):
+        result = session.execute(
+            db.select(table.c[id_column], *[table.c[column] for column in key_columns])
+            .where(table.c[key_columns[0]].in_(first_values[start:start + 500]))
+        )
+        for row_id, *key in result:
+            if tuple(key) in keys:
+                ids.setdefault(tuple(key), row_id)
+    return ids
+
+def natural_key(values):
+    """Key tuple with text compared like the case-insensitive SQL Server collation (see normalize_key)"""
+    return tuple(normalize_key(value) if isinstance(value, str) else value for value in values)
+
+def upsert_rows(session, table, batch, key_columns, id_column=None):
+    """
+    Insert rows that are new by natural key and update the ones that exist
+
+    Args:
+        session (Session): Open session, committed by the caller
+        table (Table): Target table
+        batch (dict): Column-oriented rows, column name -> list of values (see record_columns)
+        key_columns (tuple): Natural key columns
+        id_column (str): Identity column to return, if any
+    Returns:
+        dict: Natural key tuple -> identity, when id_column is given; keys
+        differing only in case or spacing share one identity
+    """
+    columns = list(batch)
+    key_indexes = [columns.index(column) for column in key_columns]
+    rows = list(zip(*batch.values()))
+    # Keep the last row per key; MERGE rejects a source that matches a target row
+    # twice, and SQL Server matches keys case-insensitively
+    unique_rows = list({natural_key(row[index] for index in key_indexes): row for row in rows}.values())
+    if not unique_rows:
+        return {}
+    if session.get_bind().dialect.name == "mssql":
+        ids = merge_rows(session, table, columns, unique_rows, key_columns, id_column)
+    else:
+        ids = update_or_insert_rows(session, table, columns, unique_rows, key_columns, id_column)
+    if not id_column:
+        return ids
+
+    ids = {natural_key(key): row_id for key, row_id in ids.items()}
+    return {
+        key: ids[natural_key(key)]
+        for key in {tuple(row[index] for index in key_indexes) for row in rows}
+        if natural_key(key) in ids
+    }
+
+def record_columns(records, names):
+    """Column-oriented batch of record attributes: name -> [record.name, ...]"""
+    return {name: list(map(attrgetter(name), records)) for name in names}
+
+def insert_to_db(data, selected_categories, engine=None, document_id=None, pages=()):
+    """
+    Insert extracted KPI data into database for each selected category
+
+    Rows are upserted set-based on their natural keys (see upsert_rows), so
+    re-processing a document updates the existing categories, KPIs and
+    standard values instead of adding duplicates. Each table gets one
+    column-oriented batch built straight from the records.
+
+    Args:
+        data (Category): Extracted KPI data (a category dict is validated first, see build_category)
+        selected_categories (list): List of categories selected by user
+        engine: Optional SQLAlchemy engine, defaults to get_engine()
+        document_id (int): Optional stored document the data was extracted from
+        pages (set): Pages of that document the data came from, recorded in document_rows as one extraction
+    """
+    try:
+        engine = engine or get_engine()
+        if isinstance(data, dict):
+            data = build_category(data)
+            if data is None:
+                raise ValueError("invalid category item")
+
+        maincat_ids = sorted({
+            category_mapping[selected_cat]
+            for selected_cat in selected_categories
+            if selected_cat in category_mapping
+        })
+        if not maincat_ids:
+            return "Success"
+
+        with Session(engine) as session:
+            try:
+                # Upsert one category row per selected main category
+                log(f"Inserting category: {data.category_name} for {len(maincat_ids)} main categories")
+                category_ids = upsert_rows(session, kpis_category_table, {
+                    "cat_name": [data.category_name] * len(maincat_ids),
+                    "cat_description": [data.category_description] * len(maincat_ids),
+                    "maincat_id": maincat_ids,
+                }, category_key_columns, "cat_id")
+
+                # Upsert all KPIs of all categories in a single batch
+                kpis = data.kpis * len(maincat_ids)
+                kpi_category_ids = [
+                    category_ids[(data.category_name, maincat_id)] for maincat_id in maincat_ids for _ in data.kpis
+                ]
+                kpi_ids = upsert_rows(session, kpis_table, {
+                    "category_id": kpi_category_ids,
+                    **record_columns(kpis, ("kpi_name", "unit", "kpi_source", "kpi_description")),
+                }, kpi_key_columns, "kpi_id")
+
+                # Upsert every standard value in a single batch; numbers were
+                # parsed when the records were built
+                value_kpi_ids = []
+                values = []
+                for category_id, kpi in zip(kpi_category_ids, kpis):
+                    kpi_id = kpi_ids[(category_id, kpi.kpi_name)]
+                    value_kpi_ids += [kpi_id] * len(kpi.standard_values)
+                    values += kpi.standard_values
+                value_ids = upsert_rows(
+                    session, standard_values_table,
+                    {"kpi_id": value_kpi_ids, **record_columns(values, standard_value_fields)},
+                    standard_value_key_columns,
+                    "standard_val_id" if document_id is not None else None
+                )
+                if document_id is not None:
+                    page_numbers = sorted(pages)
+                    linked_ids = list(set(value_ids.values()))
+                    link_count = len(linked_ids) * len(page_numbers)
+                    upsert_rows(session, document_rows_table, {
+                        "document_id": [document_id] * link_count,
+                        "page_number": page_numbers * len(linked_ids),
+                        "standard_val_id": [value_id for value_id in linked_ids for _ in page_numbers],
+                        "source_pages": [",".join(map(str, page_numbers))] * link_count,
+                    }, document_row_key_columns)
+
+                session.commit()
+                bump_data_generation()
+                metrics.inc("db_rows_upserted_total", len(maincat_ids), table="kpis_category")
+                metrics.inc("db_rows_upserted_total", len(kpis), table="kpis")
+                metrics.inc("db_rows_upserted_total", len(values), table="standard_values")
+                return "Success"
+
+            except Exception as e:
+                session.rollback()
+                raise e
+
+    except Exception as e:
+        log(f"Error in inserting to db: {str(e)}")
+        return f"Error in inserting to db: {str(e)}"
+
+def collapse_duplicates(session, table, id_column, key_columns, value_columns, child_table=None, child_column=None):
+    """
+    Keep the lowest id per natural key with the values of its newest row,
+    repoint child rows to it and delete the rest
+
+    This is the rule of upsert_rows, which keeps the existing row and
+    overwrites its values with the latest upload. A child row whose primary
+    key would then repeat one the kept row already has is deleted instead.
+
+    Returns:
+        int: Number of deleted duplicate rows
+    """
+    keep = {}
+    newest = {}
+    duplicates = {}
+    rows = session.execute(
+        db.select(
+            table.c[id_column], *[table.c[column] for column in key_columns + value_columns]
+        ).order_by(table.c[id_column])
+    )
+    for row_id, *row in rows:
+        key = natural_key(row[:len(key_columns)])
+        if key in keep:
+            duplicates[row_id] = keep[key]
+            newest[keep[key]] = row[len(key_columns):]
+        else:
+            keep[key] = row_id
+
+    if not duplicates:
+        return 0
+    if value_columns:
+        session.execute(
+            db.update(table)
+            .where(table.c[id_column] == db.bindparam("keep_id"))
+            .values({column: db.bindparam(f"new_{column}") for column in value_columns}),
+            [
+                {"keep_id": keep_id, **{f"new_{column}": value for column, value in zip(value_columns, values)}}
+                for keep_id, values in newest.items()
+            ]
+        )
+    duplicate_ids = list(duplicates)
+    if child_table is not None:
+        child = child_table.c[child_column]
+        other = child_table.alias("other")
+        session.execute(
+            db.update(child_table)
+            .where(
+                child == db.bindparam("duplicate_id"),
+                ~db.exists().where(
+                    other.c[child_column] == db.bindparam("keep_id"),
+                    *[other.c[column.name] == column for column in child_table.primary_key if column is not child],
+                ),
+            )
+            .values({child_column: db.bindparam("keep_id")}),
+            [{"keep_id": keep_id, "duplicate_id": duplicate_id} for duplicate_id, keep_id in duplicates.items()]
+        )
+        for start in range(0, len(duplicate_ids), 1000):
+            session.execute(db.delete(child_table).where(child.in_(duplicate_ids[start:start + 1000])))
+    for start in range(0, len(duplicate_ids), 1000):
+        session.execute(db.delete(table).where(table.c[id_column].in_(duplicate_ids[start:start + 1000])))
+    return len(duplicates)
+
+def compact_duplicates(engine=None):
+    """
+    One-off compaction of rows duplicated by earlier uploads
+
+    Categories are collapsed first (their KPIs may then become duplicates),
+    then KPIs, then standard values.
+
+    Returns:
+        dict: Deleted rows per table
+    """
+    engine = engine or get_engine()
+    with Session(engine) as session:
+        deleted = {
+            "kpis_category": collapse_duplicates(
+                session, kpis_category_table, "cat_id", category_key_columns, ("cat_description",),
+                kpis_table, "category_id"
+            ),
+            "kpis": collapse_duplicates(
+                session, kpis_table, "kpi_id", kpi_key_columns, ("unit", "kpi_source", "kpi_description"),
+                standard_values_table, "kpi_id"
+            ),
+            "standard_values": collapse_duplicates(
+                session, standard_values_table, "standard_val_id", standard_value_key_columns,
+                ("value_avg", "value_min", "value_max"), document_rows_table, "standard_val_id"
+            ),
+        }
+        session.commit()
+    bump_data_generation()
+    return deleted
+
+def load_document(document_name, engine=None):
+    """
+    Look up a stored document by name, registering it when it is new
+
+    Two jobs registering the same new name at once both end up with the row
+    the unique ux_documents_name index let through. Fingerprints are kept
+    per page number, so inserting or deleting a page marks every later page
+    as changed.
+
+    Args:
+        document_name (str): Name revisions of the document are uploaded under
+        engine: Optional SQLAlchemy engine, defaults to get_engine()
+    Returns:
+        tuple: (document_id, {page_number: fingerprint} stored for its pages)
+    """
+    engine = engine or get_engine()
+    with Session(engine) as session:
+        document_id = session.execute(
+            db.select(documents_table.c.document_id).where(documents_table.c.document_name == document_name)
+        ).scalar()
+        if document_id is None:
+            try:
+                document_id = session.execute(
+                    db.insert(documents_table).values(document_name=document_name)
+                ).inserted_primary_key[0]
+                session.commit()
+                return document_id, {}
+            except IntegrityError:
+                # Registered concurrently by another job
+                session.rollback()
+                document_id = session.execute(
+                    db.select(documents_table.c.document_id).where(documents_table.c.document_name == document_name)
+                ).scalar_one()
+        pages = session.execute(
+            db.select(document_pages_table.c.page_number, document_pages_table.c.fingerprint)
+            .where(document_pages_table.c.document_id == document_id)
+        )
+        return document_id, dict(pages.all())
+
+def page_extractions(document_id, pages):
+    """Select the source_pages of the extractions of a stored document that read any of the pages"""
+    page_links = document_rows_table.alias("page_links")
+    return db.select(page_links.c.source_pages).where(
+        page_links.c.document_id == document_id, page_links.c.page_number.in_(pages)
+    )
+
+def extraction_pages(document_id, pages, engine=None):
+    """
+    Every page read by the extractions that drop_page_rows() drops for the pages
+
+    A chunk spanning a changed page is dropped whole, so its unchanged pages
+    have to be extracted again.
+
+    Returns:
+        set: Page numbers, including the given ones that have stored rows
+    """
+    pages = sorted(pages)
+    if not pages:
+        return set()
+    engine = engine or get_engine()
+    links = document_rows_table
+    with Session(engine) as session:
+        return set(session.execute(
+            db.select(links.c.page_number).distinct().where(
+                links.c.document_id == document_id,
+                links.c.source_pages.in_(page_extractions(document_id, pages)),
+            )
+        ).scalars())
+
+def drop_page_rows(document_id, pages, engine=None):
+    """
+    Delete the rows extracted from some pages of a stored document
+
+    Every extraction (chunk or table) that read one of the pages is dropped as
+    a whole, including its links to unchanged pages, since a chunk spanning a
+    changed page is re-extracted. Standard values that another extraction
+    also produced are kept, KPIs left without standard values are deleted.
+    The stored fingerprints of all those pages are deleted in the same
+    transaction, so if storing the new rows fails the next revision
+    re-extracts them instead of taking them as unchanged.
+
+    Args:
+        document_id (int): Stored document, see load_document()
+        pages (set): Changed or removed page numbers
+        engine: Optional SQLAlchemy engine, defaults to get_engine()
+    Returns:
+        dict: Deleted rows per table
+    """
+    pages = sorted(pages)
+    if not pages:
+        return {}
+    engine = engine or get_engine()
+    sv = standard_values_table
+    links = document_rows_table
+    other_links = links.alias("other_links")
+    stale_extractions = page_extractions(document_id, pages)
+    stale_links = db.and_(links.c.document_id == document_id, links.c.source_pages.in_(stale_extractions))
+
+    with Session(engine) as session:
+        kpi_ids = session.execute(
+            db.select(sv.c.kpi_id).distinct()
+            .join(links, links.c.standard_val_id == sv.c.standard_val_id)
+            .where(stale_links)
+        ).scalars().all()
+
+        # Standard values produced only by the stale extractions
+        kept_elsewhere = db.exists().where(
+            other_links.c.standard_val_id == sv.c.standard_val_id,
+            db.or_(
+                other_links.c.document_id != document_id,
+                other_links.c.source_pages.not_in(stale_extractions),
+            ),
+        )
+        stale_pages = db.select(links.c.page_number).where(stale_links)
+        deleted = {
+            "document_pages": session.execute(
+                db.delete(document_pages_table).where(
+                    document_pages_table.c.document_id == document_id,
+                    db.or_(
+                        document_pages_table.c.page_number.in_(pages),
+                        document_pages_table.c.page_number.in_(stale_pages),
+                    ),
+                )
+            ).rowcount,
+            "standard_values": session.execute(
+                db.delete(sv).where(
+                    sv.c.standard_val_id.in_(db.select(links.c.standard_val_id).where(stale_links)),
+                    ~kept_elsewhere,
+                )
+            ).rowcount,
+            "document_rows": session.execute(db.delete(links).where(stale_links)).rowcount,
+            "kpis": 0,
+        }
+        for start in range(0, len(kpi_ids), mssql_max_parameters):
+            deleted["kpis"] += session.execute(
+                db.delete(kpis_table).where(
+                    kpis_table.c.kpi_id.in_(kpi_ids[start:start + mssql_max_parameters]),
+                    ~db.exists().where(sv.c.kpi_id == kpis_table.c.kpi_id),
+                )
+            ).rowcount
+        session.commit()
+    bump_data_generation()
+    return deleted
+
+def save_document_pages(document_id, file_hash, fingerprints, engine=None):
+    """
+    Record the page fingerprints of a stored revision
+
+    Args:
+        document_id (int): Stored document, see load_document()
+        file_hash (str): SHA-256 of the revision's file
+        fingerprints (dict): {page_number: fingerprint} from page_fingerprints()
+        engine: Optional SQLAlchemy engine, defaults to get_engine()
+    """
+    engine = engine or get_engine()
+    with Session(engine) as session:
+        session.execute(db.delete(document_pages_table).where(document_pages_table.c.document_id == document_id))
+        if fingerprints:
+            session.execute(
+                db.insert(document_pages_table),
+                [
+                    {"document_id": document_id, "page_number": page_number, "fingerprint": fingerprint}
+                    for page_number, fingerprint in sorted(fingerprints.items())
+                ]
+            )
+        session.execute(
+            db.update(documents_table).where(documents_table.c.document_id == document_id).values(file_hash=file_hash)
+        )
+        session.commit()
+
+
+# Define schema for standard values
+standard_values_schema = Object(
+    id="standard_values",
+    description="Standard values for a KPI",
+    attributes=[
+        Text(id="geographical_loc", description="The geographical location where the KPI data is applicable"),
+        Text(id="country", description="The specific country for the KPI data"),
+        Text(id="industry", description="The industry sector for the KPI data"),
+        Text(id="gender", description="The gender demographic for the KPI data"),
+        Text(id="age_group", description="The age group for the KPI data"),
+        Text(id="experience_level", description="The experience level for the KPI data"),
+        Text(id="value_avg", description="The average value of the KPI"),
+        Text(id="value_min", description="The minimum value of the KPI"),
+        Text(id="value_max", description="The maximum value of the KPI"),
+        Text(id="source_val", description="The source of the KPI data values")
+    ]
+)
+
+# Define schema for KPIs
+kpis_schema = Object(
+    id="kpis",
+    description="Individual KPI information",
+    attributes=[
+        Text(id="kpi_name", description="The name of the KPI"),
+        Text(id="unit", description="The unit of measurement for the KPI"),
+        Text(id="kpi_source", description="The source URL or reference for the KPI definition"),
+        Text(id="kpi_description", description="A detailed description of what the KPI measures"),
+        standard_values_schema
+    ]
+)
+
+# What the focused schema of each main category asks for
+category_focus = {
+    'Demographic': "workforce composition: headcount and the gender, age and diversity make-up of employees, managers and boards",
+    'Performance Data': "workforce performance: turnover, retention, promotions, productivity, absenteeism and engagement",
+    'Leave Policies': "leave: parental, maternity, paternity, carer's, sick and holiday leave, flexible work and their uptake",
+    'Salary Information': "pay: salaries, remuneration, bonuses, pay gaps and pay distribution by quartile",
+}
+
+def build_main_schema(examples=(), category=None):
+    """
+    Main schema for KPI categories with the given few-shot examples
+
+    Args:
+        examples (list): Example dicts from load_examples (name, text, output)
+        category (str): Main category to focus on (see category_focus), defaults to all HR KPIs
+    Returns:
+        Object: Kor schema
+    """
+    description = "KPIs related to Human Resources (HR) analysis"
+    if category in category_focus:
+        description = f"{category} KPIs about {category_focus[category]}. Leave out KPIs of other kinds"
+    return Object(
+        id="KPI_Category",
+        description=description,
+        attributes=[
+            Text(id="category_name", description="The name of the KPI category"),
+            Text(id="category_description", description="A short description of the KPI category"),
+            kpis_schema
+        ],
+        examples=[(example["text"], example["output"]) for example in examples]
+    )
+
+def example_words(text):
+    """Lower-cased words of 3+ letters, used to match documents to examples"""
+    return set(re.findall(r"[a-z]{3,}", text.lower()))
+
+def load_examples(path=None):
+    """
+    Load few-shot examples from a JSON list of {"name", "text", "output"} objects
+
+    Returns:
+        list: Examples, each with its word set added
+    """
+    with open(path or kor_examples_path, encoding="utf-8") as f:
+        examples = json.load(f)
+    for example in examples:
+        example["words"] = example_words(example["text"])
+    return examples
+
+def example_tokens(example):
+    """Approximate prompt tokens of one example (its text and JSON answer)"""
+    if "tokens" not in example:
+        example["tokens"] = count_tokens(example["text"]) + count_tokens(json.dumps(example["output"]))
+    return example["tokens"]
+
+# Few-shot examples, loaded from KOR_EXAMPLES_PATH on first use
+kor_examples = None
+
+def get_examples():
+    global kor_examples
+    if kor_examples is None:
+        kor_examples = load_examples()
+    return kor_examples
+
+def select_examples(extracted_text, mode=None, category=None):
+    """
+    Pick the few-shot examples for a text according to KOR_EXAMPLES_MODE
+
+    all: every example; none: zero-shot; relevant: the KOR_EXAMPLES_MAX examples
+    sharing the largest fraction of their words with the text, skipping those
+    scoring below KOR_EXAMPLE_MIN_SCORE. With a main category, only examples
+    listing it in their optional "categories" (or listing none) are candidates.
+
+    Returns:
+        list: Selected examples
+    """
+    mode = mode or kor_examples_mode
+    if mode == "none":
+        return []
+    examples = [
+        example for example in get_examples()
+        if category is None or category in example.get("categories", [category])
+    ]
+    if mode == "all":
+        return examples
+    words = example_words(extracted_text)
+    scored = sorted(
+        ((len(words & example["words"]) / max(len(example["words"]), 1), index) for index, example in enumerate(examples)),
+        reverse=True
+    )
+    return [
+        examples[index] for score, index in scored[:kor_examples_max] if score >= kor_example_min_score
+    ]
+
+
+# Shared Azure OpenAI client and one Kor chain per main category and example selection
+extraction_llm = None
+extraction_chains = {}
+llm_service = RateLimitedService("llm", llm_concurrency, llm_rpm, llm_tpm)
+
+def build_extraction_llm():
+    """Create the Azure OpenAI chat model used by all extraction chains"""
+    return AzureChatOpenAI(
+        openai_api_key=openai_api_key,
+        azure_endpoint=openai_endpoint,
+        model_name=openai_model_name, 
+        api_version="2024-08-01-preview",
+        # Retries and throttling are handled by llm_service
+        max_retries=0
+    )
+
+def get_extraction_chain(examples=None, category=None):
+    """
+    Return the shared extraction chain for an example selection, building it on first use
+
+    Args:
+        examples (list): Selected examples, defaults to all of them
+        category (str): Main category of the focused schema, defaults to the generic one
+    Returns:
+        tuple: (chain, schema fingerprint)
+    """
+    global extraction_llm
+    if examples is None:
+        examples = get_examples()
+    selection = (category,) + tuple(example["name"] for example in examples)
+    if selection not in extraction_chains:
+        if extraction_llm is None:
+            extraction_llm = build_extraction_llm()
+        schema = build_main_schema(examples, category)
+        extraction_chains[selection] = (
+            create_extraction_chain(extraction_llm, schema, encoder_or_encoder_class=JSONEncoder),
+            hashlib.sha256(schema.model_dump_json().encode()).hexdigest(),
+        )
+    return extraction_chains[selection]
+
+# Extraction outputs keyed by text, schema (with the selected examples), model and categories
+extraction_cache = DiskCache(llm_cache_dir, llm_cache_max_bytes, llm_cache_ttl)
+
+def invalidate_extraction_cache():
+    """Drop all cached extractions and chains, e.g. after the schema or the examples file changed"""
+    global kor_examples
+    kor_examples = None
+    extraction_chains.clear()
+    extraction_cache.clear()
+
+def extraction_cache_key(extracted_text, selected_categories, schema_fingerprint):
+    key = json.dumps([
+        hashlib.sha256(extracted_text.encode()).hexdigest(),
+        schema_fingerprint,
+        openai_model_name,
+        deployment_name,
+        sorted(selected_categories),
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+async def extract_kpis(extracted_text, selected_categories=()):
+    """
+    Run the shared Kor chain on extracted text without blocking the event loop
+
+    A single selected main category is extracted with its focused schema,
+    several with the generic one. Few-shot examples are chosen per text (see
+    select_examples) and outputs with extracted data are memoized in
+    extraction_cache.
+
+    Args:
+        extracted_text (str): Text extracted from document
+        selected_categories (list): Categories selected by user
+    Returns:
+        dict: Raw Kor output
+    """
+    category = selected_categories[0] if len(selected_categories) == 1 else None
+    examples = select_examples(extracted_text, category=category)
+    chain, schema_fingerprint = get_extraction_chain(examples, category)
+    cache_key = extraction_cache_key(extracted_text, selected_categories, schema_fingerprint)
+    cached = await asyncio.to_thread(extraction_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    prompt_tokens = count_tokens(chain.first.format_prompt(text=extracted_text).to_string())
+
+    async def invoke():
+        with get_openai_callback() as usage, time_stage("llm"):
+            return await chain.ainvoke(extracted_text), usage
+
+    output, usage = await llm_service.call(invoke, tokens=prompt_tokens + llm_completion_tokens)
+    record_token_usage(output, usage, prompt_tokens, examples)
+
+    if isinstance(output, dict) and output.get("data"):
+        await asyncio.to_thread(extraction_cache.put, cache_key, {"data": output["data"]})
+    return output
+
+# Token totals of the current request or job, see new_token_report()
+current_token_report = contextvars.ContextVar("token_report", default=None)
+
+def new_token_report():
+    """Start collecting the token usage of all extractions in the current context"""
+    report = {"calls": 0, "prompt_tokens": 0, "example_tokens": 0, "completion_tokens": 0}
+    current_token_report.set(report)
+    return report
+
+def record_token_usage(output, usage, prompt_tokens, examples=()):
+    """
+    Count LLM tokens in llm_tokens_total and the current token report
+
+    Uses the usage reported by the model; models that report none (e.g.
+    stubs, some proxies) are counted with count_tokens on the rendered
+    prompt (prompt_tokens) and the raw completion instead.
+    """
+    if usage.total_tokens:
+        prompt_tokens, completion_tokens, source = usage.prompt_tokens, usage.completion_tokens, "reported"
+    else:
+        raw = output.get("raw") if isinstance(output, dict) else None
+        completion_tokens = count_tokens(raw or "")
+        source = "estimated"
+    examples_tokens = sum(example_tokens(example) for example in examples)
+    metrics.inc("llm_tokens_total", prompt_tokens, direction="prompt", source=source)
+    metrics.inc("llm_tokens_total", completion_tokens, direction="completion", source=source)
+    metrics.inc("llm_example_tokens_total", examples_tokens)
+    log(f"Extraction tokens ({source}): prompt {prompt_tokens} incl. ~{examples_tokens} from "
+        f"{len(examples)} examples, completion {completion_tokens}")
+
+    report = current_token_report.get()
+    if report is not None:
+        report["calls"] += 1
+        report["prompt_tokens"] += prompt_tokens
+        report["example_tokens"] += examples_tokens
+        report["completion_tokens"] += completion_tokens
+
+# Validated extraction output, built once by build_category() and handed to
+# insert_to_db() as column batches
+@dataclass(slots=True)
+class StandardValue:
+    geographical_loc: str | None = None
+    country: str | None = None
+    industry: str | None = None
+    gender: str | None = None
+    age_group: str | None = None
+    experience_level: str | None = None
+    value_avg: float | None = None
+    value_min: float | None = None
+    value_max: float | None = None
+    source_val: str | None = None
+
+@dataclass(slots=True)
+class Kpi:
+    kpi_name: str
+    unit: str | None = None
+    kpi_source: str | None = None
+    kpi_description: str | None = None
+    standard_values: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class Category:
+    category_name: str
+    category_description: str | None = None
+    kpis: list = field(default_factory=list)
+
+standard_value_fields = StandardValue.__slots__
+standard_value_text_fields = tuple(name for name in standard_value_fields if not name.startswith("value_"))
+
+def build_category(item):
+    """
+    Validate one extracted category dict into a Category record
+
+    KPIs that are not objects with a kpi_name and standard values that are
+    not objects are dropped; values are parsed with parse_number.
+
+    Args:
+        item (dict): Category object from the Kor output
+    Returns:
+        Category: Record, or None if the item is not a valid category
+    """
+    if not isinstance(item, dict):
+        return None
+    kpis = item.get("kpis")
+    if "category_name" not in item or "category_description" not in item or not isinstance(kpis, list):
+        return None
+
+    records = []
+    for kpi in kpis:
+        if not isinstance(kpi, dict) or "kpi_name" not in kpi:
+            continue
+        values = kpi.get("standard_values")
+        if isinstance(values, dict):
+            values = [values]
+        records.append(Kpi(
+            kpi["kpi_name"], kpi.get("unit"), kpi.get("kpi_source"), kpi.get("kpi_description"),
+            [
+                StandardValue(
+                    value.get("geographical_loc"), value.get("country"), value.get("industry"),
+                    value.get("gender"), value.get("age_group"), value.get("experience_level"),
+                    parse_number(value.get("value_avg")), parse_number(value.get("value_min")),
+                    parse_number(value.get("value_max")), value.get("source_val"),
+                )
+                for value in values or [] if isinstance(value, dict)
+            ],
+        ))
+    return Category(item["category_name"], item["category_description"], records)
+
+def parse_extraction_output(output):
+    """
+    Pull the KPI_Category items out of a raw Kor output
+
+    Args:
+        output (dict): Raw Kor output
+    Returns:
+        list: Valid Category records, or None if the output structure is invalid
+    """
+    if not (output and isinstance(output, dict) and "data" in output):
+        log("Invalid output structure")
+        log(f"Output: {json.dumps(output, indent=2)}")
+        return None
+
+    data = output["data"]
+
+    if isinstance(data, str):
+        log(f"Skipping string data: {data}")
+        return None
+
+    # Process nested KPI_Category structure
+    if isinstance(data, dict):
+        if "KPI_Category" in data:
+            data = data["KPI_Category"]
+        data_to_process = data if isinstance(data, list) else [data]
+    elif isinstance(data, list):
+        data_to_process = [
+            item["KPI_Category"] if isinstance(item, dict) and "KPI_Category" in item else item
+            for item in data
+        ]
+    else:
+        log(f"Unexpected data type: {type(data)}")
+        return None
+
+    items = []
+    for item in data_to_process:
+        category = build_category(item)
+        if category is None:
+            log(f"Skipping invalid category item: {str(item)[:200]}")
+            continue
+        items.append(category)
+    log(f"Extraction output: {len(items)} categories, {sum(len(item.kpis) for item in items)} KPIs")
+    return items
+
+def normalize_key(value):
+    """Case and whitespace insensitive key used to deduplicate extraction results"""
+    return " ".join(str(value or "").split()).casefold()
+
+def merge_extractions(items):
+    """
+    Merge category items extracted from several chunks
+
+    Categories are merged by name, KPIs by name within their category and
+    standard values by their natural key (standard_value_key_columns), the
+    last one winning as it does in upsert_rows.
+
+    Args:
+        items (list): Category records from parse_extraction_output or table_to_item
+    Returns:
+        list: Deduplicated Category records
+    """
+    categories = {}
+    for item in items:
+        category_key = normalize_key(item.category_name)
+        if category_key not in categories:
+            categories[category_key] = (Category(item.category_name, item.category_description), {})
+        category, kpis = categories[category_key]
+        if not category.category_description:
+            category.category_description = item.category_description
+
+        for kpi in item.kpis:
+            kpi_key = normalize_key(kpi.kpi_name)
+            if kpi_key not in kpis:
+                merged_kpi = Kpi(kpi.kpi_name, kpi.unit, kpi.kpi_source, kpi.kpi_description)
+                kpis[kpi_key] = (merged_kpi, {})
+                category.kpis.append(merged_kpi)
+            merged_kpi, seen_values = kpis[kpi_key]
+            merged_kpi.unit = merged_kpi.unit or kpi.unit
+            merged_kpi.kpi_source = merged_kpi.kpi_source or kpi.kpi_source
+            merged_kpi.kpi_description = merged_kpi.kpi_description or kpi.kpi_description
+
+            for std_value in kpi.standard_values:
+                value_key = natural_key(getattr(std_value, name) for name in standard_value_text_fields)
+                if value_key in seen_values:
+                    merged_kpi.standard_values[seen_values[value_key]] = std_value
+                else:
+                    seen_values[value_key] = len(merged_kpi.standard_values)
+                    merged_kpi.standard_values.append(std_value)
+
+    return [category for category, _ in categories.values()]
+
+def extraction_groups(selected_categories):
+    """
+    Main categories extracted together, each group stored only under its own categories
+
+    Returns:
+        list: One single-category tuple per selected main category, or with
+            CATEGORY_EXTRACTION=false a single tuple of all of them
+    """
+    if not category_extraction or len(selected_categories) < 2:
+        return [tuple(selected_categories)]
+    return [(category,) for category in selected_categories]
+
+def match_groups(text, selected_categories):
+    """
+    Extraction groups whose category keywords a text mentions most
+
+    Used for results that were not extracted per category (the table fast
+    path); text matching no keywords belongs to every group.
+    """
+    groups = extraction_groups(selected_categories)
+    if len(groups) == 1:
+        return groups
+    words = example_words(text)
+    hits = {group: len(words & category_keywords.get(group[0], set())) for group in groups}
+    best = max(hits.values())
+    return [group for group in groups if hits[group] == best] if best else groups
+
+async def extract_chunk_items(chunks, selected_categories):
+    """
+    Extract KPI categories from every document chunk for every extraction group
+
+    Chunks and groups (see extraction_groups) are extracted concurrently, at
+    most EXTRACTION_FAN_OUT at a time. A chunk with fewer than
+    CATEGORY_MIN_KEYWORDS keywords of a category is not sent to its extraction.
+
+    Args:
+        chunks (list): Text chunks from chunk_layout
+        selected_categories (list): Categories selected by user
+    Returns:
+        list: Per chunk, {group: Category records, or None without a valid output}
+    """
+    fan_out = asyncio.Semaphore(extraction_fan_out)
+    groups = extraction_groups(selected_categories)
+
+    async def extract_chunk(chunk, group):
+        if len(group) == 1 and category_min_keywords:
+            keyword_hits = len(example_words(chunk) & category_keywords.get(group[0], set()))
+            if keyword_hits < category_min_keywords:
+                metrics.inc("extraction_chunks_total", category=group[0], decision="skipped")
+                return []
+        metrics.inc("extraction_chunks_total", category="+".join(group), decision="sent")
+        async with fan_out:
+            output = await extract_kpis(chunk, list(group))
+        return parse_extraction_output(output)
+
+    log(f"Extracting KPIs from {len(chunks)} chunks for {len(groups)} category groups")
+    outputs = await asyncio.gather(*[extract_chunk(chunk, group) for chunk in chunks for group in groups])
+    return [dict(zip(groups, outputs[index:index + len(groups)])) for index in range(0, len(outputs), len(groups))]
+
+def store_items(items, selected_categories, document_id=None, pages=()):
+    """
+    Insert extracted categories into the database
+
+    Args:
+        items (list): Category records from merge_extractions
+        selected_categories (list): Categories selected by user
+        document_id (int): Optional stored document the items were extracted from
+        pages (set): Pages of that document the items came from
+    Returns:
+        list: insert_to_db result per item
+    """
+    results = []
+    for item in items:
+        try:
+            with time_stage("insert_to_db"):
+                insert_result = insert_to_db(item, selected_categories, document_id=document_id, pages=pages)
+            log(f"Database insertion result: {insert_result}")
+            results.append(insert_result)
+
+        except Exception as insert_error:
+            log(f"Error inserting item into database: {str(insert_error)}")
+            log(f"Item that caused error: {json.dumps(asdict(item), indent=2)}")
+            results.append(f"Error inserting item into database: {str(insert_error)}")
+    return results
+
+# Lazily loaded tiktoken encoding, see count_tokens()
+tiktoken_encoding = None
+
+def count_tokens(text):
+    """Count prompt tokens with tiktoken when installed, otherwise estimate ~4 characters per token"""
+    global tiktoken_encoding
+    if tiktoken is not None and tiktoken_encoding is None:
+        try:
+            tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # The encoding is downloaded on first use; estimate when that is not possible
+            log(f"tiktoken unavailable, estimating token counts: {str(e)}")
+            tiktoken_encoding = False
+    if not tiktoken_encoding:
+        return len(text) // 4 + 1
+    return len(tiktoken_encoding.encode(text))
+
+def pack_blocks(blocks, max_tokens):
+    """
+    Greedily pack text blocks into chunks of at most max_tokens
+
+    Blocks are strings, or (text, pages) pairs, in which case the chunks are
+    (text, pages) pairs too, with the pages of all blocks they hold. Blocks
+    larger than max_tokens are split on line boundaries.
+    """
+    tagged = bool(blocks) and isinstance(blocks[0], tuple)
+    chunks = []
+    current = []
+    current_pages = set()
+    current_tokens = 0
+    for block in blocks:
+        block_text, block_pages = block if tagged else (block, ())
+        block_tokens = count_tokens(block_text)
+        if block_tokens > max_tokens:
+            lines = block_text.split("\n")
+            if len(lines) > 1:
+                middle = len(lines) // 2
+                split_blocks = ["\n".join(lines[:middle]), "\n".join(lines[middle:])]
+                for chunk in pack_blocks(split_blocks, max_tokens):
+                    if current:
+                        chunks.append(("\n".join(current), current_pages))
+                        current, current_pages, current_tokens = [], set(), 0
+                    chunks.append((chunk, set(block_pages)))
+                continue
+        if current and current_tokens + block_tokens > max_tokens:
+            chunks.append(("\n".join(current), current_pages))
+            current, current_pages, current_tokens = [], set(), 0
+        current.append(block_text)
+        current_pages.update(block_pages)
+        current_tokens += block_tokens
+    if current:
+        chunks.append(("\n".join(current), current_pages))
+    return chunks if tagged else [chunk for chunk, _ in chunks]
+
+category_keywords = {
+    'Demographic': {"gender", "women", "men", "female", "male", "age", "diversity", "workforce", "employees", "headcount"},
+    'Performance Data': {"performance", "turnover", "retention", "productivity", "absenteeism", "engagement", "promotion"},
+    'Leave Policies': {"leave", "parental", "maternity", "paternity", "carer", "holiday", "sick", "flexible"},
+    'Salary Information': {"salary", "pay", "remuneration", "wage", "wages", "bonus", "compensation", "earnings", "gap"},
+}
+number_pattern = re.compile(r"\d[\d,]*(?:\.\d+)?")
+money_pattern = re.compile(r"%|[$€£]|\b(?:AUD|USD|EUR|GBP)\b")
+
+def score_page(text, table_count, keywords):
+    """
+    Cheap estimate of how likely a page holds KPI values
+
+    Args:
+        text (str): Page text
+        table_count (int): Tables found on the page by the layout model
+        keywords (set): Lower-case category keywords
+    Returns:
+        float: Score, 0 for pages without any numbers
+    """
+    words = text.split()
+    numbers = len(number_pattern.findall(text))
+    if not words or not numbers:
+        return 0.0
+    density = min(numbers / len(words), 0.5) * 10
+    money = min(len(money_pattern.findall(text)), 10) * 0.5
+    keyword_hits = min(len(example_words(text) & keywords), 5)
+    return density + money + 3 * min(table_count, 2) + keyword_hits
+
+def select_pages(result, selected_categories=()):
+    """
+    Page numbers worth extracting, by score_page against PAGE_MIN_SCORE and PAGE_TOP_K
+
+    The best page is always kept so a document never ends up empty.
+
+    Args:
+        result (AnalyzeResult): Document Intelligence layout result
+        selected_categories (list): Categories selected by user, for the keywords
+    Returns:
+        set: Selected page numbers, or None when the filter is disabled
+    """
+    if not page_filter_enabled or not result.pages:
+        return None
+    keywords = set().union(*(category_keywords.get(category, set()) for category in selected_categories or category_keywords))
+    tables = {}
+    for table in result.tables or []:
+        for page_number in {region.page_number for region in table.bounding_regions or []}:
+            tables[page_number] = tables.get(page_number, 0) + 1
+
+    scored = sorted(
+        (
+            (score_page("\n".join(line.content for line in page.lines or []), tables.get(page.page_number, 0), keywords),
+             page.page_number)
+            for page in result.pages
+        ),
+        key=lambda item: (-item[0], item[1])
+    )
+    kept = [page_number for score, page_number in scored if score >= page_min_score]
+    if page_top_k:
+        kept = kept[:page_top_k]
+    kept = set(kept or [scored[0][1]])
+    metrics.inc("pages_filtered_total", len(kept), decision="kept")
+    metrics.inc("pages_filtered_total", len(scored) - len(kept), decision="dropped")
+    return kept
+
+def page_fingerprints(result, selected_categories=()):
+    """
+    Fingerprint the text of every page of a layout result
+
+    The selected categories are part of the fingerprint, so extracting a
+    revision for other categories re-extracts every page.
+
+    Returns:
+        dict: {page_number: SHA-256 hex digest}
+    """
+    categories = "\n".join(sorted(selected_categories))
+    return {
+        page.page_number: hashlib.sha256(
+            "\n".join([categories] + [line.content for line in page.lines or []]).encode("utf-8")
+        ).hexdigest()
+        for page in result.pages or []
+    }
+
+def table_grid(table):
+    """
+    Cell texts of a layout table as a rows x columns grid
+
+    Spanned cells are repeated in every row/column they cover.
+
+    Returns:
+        tuple: (grid, number of leading column header rows)
+    """
+    grid = [[""] * table.column_count for _ in range(table.row_count)]
+    header_rows = set()
+    for cell in table.cells:
+        rows = range(cell.row_index, min(cell.row_index + (cell.row_span or 1), table.row_count))
+        for row in rows:
+            for column in range(cell.column_index, min(cell.column_index + (cell.column_span or 1), table.column_count)):
+                grid[row][column] = " ".join(cell.content.split())
+        if cell.kind == "columnHeader":
+            header_rows.update(rows)
+    header_count = 0
+    while header_count in header_rows:
+        header_count += 1
+    return grid, header_count
+
+def table_header(grid, header_count):
+    """One header per column, joining the distinct texts of multi-row headers"""
+    return [
+        " ".join(dict.fromkeys(grid[row][column] for row in range(header_count) if grid[row][column]))
+        for column in range(len(grid[0]) if grid else 0)
+    ]
+
+def table_to_markdown(table):
+    """Render a layout table (and its caption) as a compact markdown table"""
+    grid, header_count = table_grid(table)
+    if not grid or not grid[0]:
+        return ""
+    header_count = max(header_count, 1)
+    rows = [table_header(grid, header_count)] + grid[header_count:]
+    rows = ["| " + " | ".join(value.replace("|", "\\|") for value in row) + " |" for row in rows]
+    lines = [table.caption.content] if table.caption else []
+    lines += [rows[0], "|" + "---|" * len(grid[0])] + rows[1:]
+    return "\n".join(lines)
+
+# Column headers the table fast path understands: value statistics first, then dimensions
+table_value_fields = [
+    ("value_avg", re.compile(r"\b(average|mean|avg)\b", re.I)),
+    ("value_min", re.compile(r"\b(min|minimum|lowest)\b", re.I)),
+    ("value_max", re.compile(r"\b(max|maximum|highest)\b", re.I)),
+]
+table_dimension_fields = [
+    ("gender", re.compile(r"\b(women|men|female|male|females|males)\b", re.I)),
+    ("age_group", re.compile(r"\b(age|aged|under \d+|over \d+|\d{2}\s*[-–]\s*\d{2}|\d{2}\+)(\b|$)", re.I)),
+    ("experience_level", re.compile(r"\b(managers?|non-managers?|ceos?|executives?|senior|junior|graduates?|level \w+)\b", re.I)),
+]
+table_missing_values = {"", "-", "–", "n/a", "na", "*"}
+
+def table_unit(texts):
+    """Unit of a table column from its header and cells: percentage, currency or number"""
+    text = " ".join(texts)
+    return "percentage" if "%" in text else "currency" if re.search(r"[$€£]", text) else "number"
+
+def table_to_item(table, category_name, source):
+    """
+    Map a well-formed layout table straight to a KPI category item
+
+    Well-formed means: header row(s), text row labels in the first column,
+    every other column header naming a statistic (average/min/max) and/or a
+    dimension (gender, age group, experience level), and at least 80% of
+    the value cells numeric. Each row becomes a KPI and each dimension
+    value a standard value. The unit is detected per column; a row whose
+    columns have different units becomes one KPI per unit. The caption is
+    kept as the category description and cut to fit the category name.
 
-# Azure Document Intelligence
-key = os.getenv("DOCUMENTINTELLIGENCE_API_KEY")
-endpoint = os.getenv("DOCUMENTINTELLIGENCE_ENDPOINT")
+    Args:
+        table (DocumentTable): Layout table
+        category_name (str): Table caption or the heading above the table
+        source (str): Document name, stored as KPI and value source
+    Returns:
+        Category: Category record as produced by extraction, or None if the table needs the LLM
+    """
+    grid, header_count = table_grid(table)
+    if not category_name or not header_count or len(grid) <= header_count or len(grid[0]) < 2:
+        return None
 
-# Azure OpenAI Configuration
-openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai_api_key = os.getenv("AZURE_OPENAI_API_KEY")
-deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+    columns = []
+    for header in table_header(grid, header_count)[1:]:
+        value_field = next((name for name, pattern in table_value_fields if pattern.search(header)), None)
+        dimensions = tuple(
+            (name, pattern.search(header).group(0)) for name, pattern in table_dimension_fields if pattern.search(header)
+        )
+        if not value_field and not dimensions:
+            return None
+        columns.append((value_field or "value_avg", dimensions))
 
-#db configuration
-driver_name = os.getenv("DRIVER_NAME")
-server_name = os.getenv("SERVER_NAME")
-database_name = os.getenv("DATABASE_NAME")
-username = os.getenv("USERNAME_1")
-password = os.getenv("PASSWORD")
+    body = grid[header_count:]
+    values = [cell for row in body for cell in row[1:] if cell.lower() not in table_missing_values]
+    numbers = [parse_number(cell) for cell in values]
+    if not values or sum(number is not None for number in numbers) < 0.8 * len(values):
+        return None
+    if any(not row[0] or parse_number(row[0]) is not None for row in body):
+        return None
 
-# Create connection string
-connection_string = (
-    f'Driver={driver_name};'
-    f'Server=tcp:{server_name}.database.windows.net,1433;'
-    f'Database={database_name};'
-    f'Uid={username};'
-    f'Pwd={password};'
-    'Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
-)
+    units = [
+        table_unit([header] + [row[index] for row in body])
+        for index, header in enumerate(table_header(grid, header_count)[1:], 1)
+    ]
 
-# Initialize Blob Service Client
-#blob_service_client = BlobServiceClient.from_connection_string(azure_storage_connection_string)
-#container_client = blob_service_client.get_container_client(container_name)
+    kpis = []
+    for row in body:
+        standard_values = {}
+        for (value_field, dimensions), unit, cell in zip(columns, units, row[1:]):
+            number = parse_number(cell)
+            if number is None:
+                continue
+            std_value = standard_values.get((unit, dimensions))
+            if std_value is None:
+                std_value = standard_values[(unit, dimensions)] = StandardValue(source_val=source, **dict(dimensions))
+            setattr(std_value, value_field, number)
+        row_units = list(dict.fromkeys(unit for unit, _ in standard_values))
+        for unit in row_units:
+            kpi_name = row[0] if len(set(units)) == 1 else f"{row[0]} ({unit})"
+            kpis.append(Kpi(
+                kpi_name, unit, source, f"{row[0]} ({category_name})",
+                [std_value for (value_unit, _), std_value in standard_values.items() if value_unit == unit]
+            ))
+    if not kpis:
+        return None
+    name_length = kpis_category_table.c.cat_name.type.length
+    description_length = kpis_category_table.c.cat_description.type.length
+    return Category(category_name[:name_length].rstrip(), category_name[:description_length], kpis)
 
-def get_engine():
-    params = urllib.parse.quote(connection_string)
-    url = f"mssql+pyodbc:///?odbc_connect={params}"
-    return db.create_engine(url)
+def table_items(result, pages=None, source=None):
+    """
+    Run the table fast path over a layout result
+
+    Args:
+        result (AnalyzeResult): Document Intelligence layout result
+        pages (set): Page numbers to consider (see select_pages), defaults to all
+        source (str): Document name for kpi_source/source_val
+    Returns:
+        tuple: (category items, {table index: item} of the tables they came from)
+    """
+    headings = sorted(
+        (paragraph.spans[0].offset, paragraph.content)
+        for paragraph in result.paragraphs or []
+        if paragraph.role in ("title", "sectionHeading") and paragraph.spans
+    )
+    items, handled = [], {}
+    for index, table in enumerate(result.tables or []):
+        page_numbers = [region.page_number for region in table.bounding_regions or []]
+        if pages is not None and not any(page_number in pages for page_number in page_numbers):
+            continue
+        offset = table.spans[0].offset if table.spans else 0
+        category_name = table.caption.content if table.caption else next(
+            (content for heading_offset, content in reversed(headings) if heading_offset < offset), None
+        )
+        item = table_to_item(table, category_name, source)
+        if item:
+            items.append(item)
+            handled[index] = item
+        metrics.inc("tables_total", path="direct" if item else "llm")
+    return items, handled
 
-def insert_to_db(data, selected_categories):
+def chunk_layout(result, max_tokens=None, pages=None, handled_tables=(), with_pages=False):
     """
-    Insert extracted KPI data into database for each selected category
-    
+    Split a prebuilt-layout result into extraction chunks
+
+    Chunks break on page boundaries, and pages that are too large on their
+    own are split at section headings found by the layout model. Tables are
+    rendered as markdown in place of their lines; tables already mapped by
+    the fast path (see table_items) are left out.
+
     Args:
-        data (dict): Extracted KPI data
-        selected_categories (list): List of categories selected by user
+        result (AnalyzeResult): Document Intelligence layout result
+        max_tokens (int): Token budget per chunk, defaults to CHUNK_MAX_TOKENS
+        pages (set): Page numbers to include (see select_pages), defaults to all
+        handled_tables (set): Indexes of tables not to send to the LLM
+        with_pages (bool): Return (text, page numbers) pairs instead of texts
+    Returns:
+        list: Text chunks in document order
     """
-    try:
-        engine = get_engine()
-        
-        def convert_to_float_or_none(value):
-            """Convert string values to float or None if invalid"""
-            if value in ['N/A', '', None]:
-                return None
-            try:
-                return float(value)
-            except (ValueError, TypeError):
-                return None
-
-        # Map category names to their database IDs
-        category_mapping = {
-            'Demographic': 1,
-            'Performance Data': 2,
-            'Leave Policies': 3,
-            'Salary Information': 4
-        }
+    max_tokens = max_tokens or chunk_max_tokens
 
-        with Session(engine) as session:
-            try:
-                # Process each selected category
-                for selected_cat in selected_categories:
-                    if selected_cat in category_mapping:
-                        maincat_id = category_mapping[selected_cat]
-                        
-                        # Insert category information
-                        print(f"Inserting category: {data['category_name']} with maincat_id: {maincat_id}")
-                        session.execute(
-                            text("""
-                                INSERT INTO kpis_category (cat_name, cat_description, maincat_id) 
-                                VALUES (:cat_name, :cat_description, :maincat_id)
-                            """),
-                            {
-                                "cat_name": data["category_name"],
-                                "cat_description": data["category_description"],
-                                "maincat_id": maincat_id
-                            }
-                        )
-                        session.flush()
-                        
-                        # Get the newly created category ID
-                        result = session.execute(text("SELECT @@IDENTITY AS cat_id"))
-                        category_id = result.scalar()
-                        
-                        # Insert KPIs for this category
-                        for kpi in data["kpis"]:
-                            # Insert KPI information
-                            session.execute(
-                                text("""
-                                    INSERT INTO kpis (category_id, kpi_name, unit, kpi_source, kpi_description) 
-                                    VALUES (:category_id, :kpi_name, :unit, :kpi_source, :kpi_description)
-                                """),
-                                {
-                                    "category_id": category_id,
-                                    "kpi_name": kpi["kpi_name"],
-                                    "unit": kpi["unit"],
-                                    "kpi_source": kpi["kpi_source"],
-                                    "kpi_description": kpi["kpi_description"]
-                                }
-                            )
-                            session.flush()
-                            
-                            # Get the newly created KPI ID
-                            result = session.execute(text("SELECT @@IDENTITY AS kpi_id"))
-                            kpi_id = result.scalar()
-                            
-                            # Insert standard values for this KPI
-                            if "standard_values" in kpi:
-                                for std_value in kpi["standard_values"]:
-                                    session.execute(
-                                        text("""
-                                            INSERT INTO standard_values 
-                                            (kpi_id, geographical_loc, country, industry, gender, 
-                                             age_group, experience_level, value_avg, value_min, 
-                                             value_max, source_val) 
-                                            VALUES 
-                                            (:kpi_id, :geographical_loc, :country, :industry, :gender,
-                                             :age_group, :experience_level, :value_avg, :value_min,
-                                             :value_max, :source_val)
-                                        """),
-                                        {
-                                            "kpi_id": kpi_id,
-                                            "geographical_loc": std_value["geographical_loc"],
-                                            "country": std_value["country"],
-                                            "industry": std_value["industry"],
-                                            "gender": std_value["gender"],
-                                            "age_group": std_value["age_group"],
-                                            "experience_level": std_value["experience_level"],
-                                            "value_avg": convert_to_float_or_none(std_value["value_avg"]),
-                                            "value_min": convert_to_float_or_none(std_value["value_min"]),
-                                            "value_max": convert_to_float_or_none(std_value["value_max"]),
-                                            "source_val": std_value["source_val"]
-                                        }
-                                    )
-                
-                session.commit()
-                return "Success"
-                
-            except Exception as e:
-                session.rollback()
-                raise e
-                
-    except Exception as e:
-        print(f"Error in inserting to db: {str(e)}")
-        return f"Error in inserting to db: {str(e)}"
+    # Content ranges covered by tables, and the markdown of each table on its first page
+    table_spans = []
+    table_blocks = {}
+    for index, table in enumerate(result.tables or []):
+        table_spans += [(span.offset, span.offset + span.length) for span in table.spans or []]
+        if index in handled_tables or not table.bounding_regions:
+            continue
+        offset = table.spans[0].offset if table.spans else 0
+        table_blocks.setdefault(table.bounding_regions[0].page_number, []).append((offset, table_to_markdown(table)))
+
+    def in_table(line):
+        offset = line.spans[0].offset if line.spans else -1
+        return any(start <= offset < end for start, end in table_spans)
+
+    # Section headings per page
+    headings = {}
+    for paragraph in result.paragraphs or []:
+        if paragraph.role in ("title", "sectionHeading"):
+            for region in paragraph.bounding_regions or []:
+                headings.setdefault(region.page_number, set()).add(paragraph.content)
 
+    blocks = []
+    for page in result.pages or []:
+        if pages is not None and page.page_number not in pages:
+            continue
+        page_items = [
+            (line.spans[0].offset if line.spans else 0, line.content)
+            for line in page.lines or [] if not in_table(line)
+        ]
+        page_items += table_blocks.get(page.page_number, [])
+        page_lines = [content for _, content in sorted(page_items, key=lambda item: item[0])]
+        page_text = "\n".join(page_lines)
+        if not page_text.strip():
+            continue
+        if count_tokens(page_text) <= max_tokens:
+            blocks.append((page_text, {page.page_number}))
+            continue
 
-async def open_ai(extracted_text, selected_categories):
+        page_headings = headings.get(page.page_number, set())
+        section = []
+        for line in page_lines:
+            if line in page_headings and section:
+                blocks.append(("\n".join(section), {page.page_number}))
+                section = []
+            section.append(line)
+        if section:
+            blocks.append(("\n".join(section), {page.page_number}))
+
+    chunks = pack_blocks(blocks, max_tokens)
+    return chunks if with_pages else [chunk for chunk, _ in chunks]
+
+async def save_upload(file, file_path):
     """
-    Process extracted text using OpenAI to identify and structure KPI data
-    
+    Stream an uploaded file to disk in UPLOAD_CHUNK_SIZE pieces while hashing it
+
     Args:
-        extracted_text (str): Text extracted from document
-        selected_categories (list): Categories selected by user
+        file (FileStorage): Uploaded file
+        file_path (str): Destination path
     Returns:
-        bool: True if processing successful, False otherwise
+        str: SHA-256 hex digest of the file content
+    Raises:
+        ValueError: If the file is larger than MAX_UPLOAD_BYTES
     """
+    max_bytes = app.config['MAX_CONTENT_LENGTH']
+    digest = hashlib.sha256()
+    size = 0
     try:
-        # Initialize Azure OpenAI
-        llm = AzureChatOpenAI(
-            openai_api_key=openai_api_key,
-            azure_endpoint=openai_endpoint,
-            model_name="gpt-4", 
-            api_version="2024-08-01-preview"
-        )
+        async with aiofiles.open(file_path, "wb") as out:
+            while True:
+                chunk = await asyncio.to_thread(file.stream.read, upload_chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ValueError(f"File is larger than {max_bytes} bytes")
+                digest.update(chunk)
+                await out.write(chunk)
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    return digest.hexdigest()
 
-        # Define schema for standard values
-        standard_values_schema = Object(
-            id="standard_values",
-            description="Standard values for a KPI",
-            attributes=[
-                Text(id="geographical_loc", description="The geographical location where the KPI data is applicable"),
-                Text(id="country", description="The specific country for the KPI data"),
-                Text(id="industry", description="The industry sector for the KPI data"),
-                Text(id="gender", description="The gender demographic for the KPI data"),
-                Text(id="age_group", description="The age group for the KPI data"),
-                Text(id="experience_level", description="The experience level for the KPI data"),
-                Text(id="value_avg", description="The average value of the KPI"),
-                Text(id="value_min", description="The minimum value of the KPI"),
-                Text(id="value_max", description="The maximum value of the KPI"),
-                Text(id="source_val", description="The source of the KPI data values")
-            ]
-        )
+def hash_file(file_path):
+    """SHA-256 hex digest of a file, read in UPLOAD_CHUNK_SIZE pieces"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(upload_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-        # Define schema for KPIs
-        kpis_schema = Object(
-            id="kpis",
-            description="Individual KPI information",
-            attributes=[
-                Text(id="kpi_name", description="The name of the KPI"),
-                Text(id="unit", description="The unit of measurement for the KPI"),
-                Text(id="kpi_source", description="The source URL or reference for the KPI definition"),
-                Text(id="kpi_description", description="A detailed description of what the KPI measures"),
-                standard_values_schema
-            ]
-        )
+def pdf_page_count(file_path):
+    """
+    Number of pages of a PDF, or None if it cannot be determined
 
-        # Define main schema for KPI categories
-        main_schema = Object(
-            id="KPI_Category",
-            description="KPIs related to Human Resources (HR) analysis",
-            attributes=[
-                Text(id="category_name", description="The name of the KPI category"),
-                Text(id="category_description", description="A short description of the KPI category"),
-                kpis_schema
-            ],
-            examples=[
-                (
-                    """December 2023
-                WGEA Mining Industry Snapshot
-                About this Snapshot
-                . This Industry Snapshot is a summary of performance against the Gender Equality Indicators of all
-                employers in the Mining industry from their 2022-23 submission to the Workplace Gender Equality
-                Agency's (WGEA) annual Gender Equality Reporting.
-                · Employers should read this Snapshot in conjunction with their 2022-23 WGEA Executive Summary,
-                which details their organisation's performance against each Gender Equality Indicator, so that they
-                can compare their performance against that of their industry.
-                . Further comparisons of performance by industry or with other organisations, such as specific
-                industry peers, is possible using WGEA's Data Explorer on the WGEA website. WGEA's annual
-                Gender Equality Scorecard also provides industry-specific insights.
-                Gender Pay Gap (GPG)
-                The gender pay gap is the difference in average earnings between women and men in the workforce. It is
-                not to be confused with women and men being paid the same for the same, or comparable, job - this is
-                equal pay.
-                The gender pay gap is a useful proxy for measuring and tracking gender equality across a nation, industry or
-                within an organisation. Closing the gender pay gap is important for Australia's economic future and reflects
-                our aspiration to be an equal and fair society for all.
-                A positive percentage indicates that men are paid more on average than women. A negative percentage
-                indicates that women are paid more on average than men.
-                2020-21
-                2021-22
-                2022-23
-                Average (mean) total remuneration
-                14.1%
-                14.2%
-                12.7%
-                Median total remuneration
-                15.6%
-                16.6%
-                15.1%
-                Average (mean) base salary
-                11.2%
-                11.9%
-                9.9%
-                Median base salary
-                13.3%
-                14.7%
-                12.3%
-                Note:
-                · Part-time/casuals/part-year employee remuneration is annualised to full-time equivalent.
-                · The 2022-23 gender pay gap calculation does not include voluntary salary data submitted for CEO, Head of Business(es),
-                and Casual managers. It also excludes employees who did not receive any payment during the reporting period.
-                · Employees identified as non-binary are excluded while the Agency establishes the baseline level for this new information.
-                Workplace Gender Equality Agency | WGEA Mining Industry Snapshot | www.wgea.gov.au
-                1
-                Gender composition by pay quartile
-                The chart below divides the Mining workforce into four equal quartiles of employees by total remuneration
-                full-time equivalent pay. The number in each pay quartile represents the proportion of each gender.
-                A disproportionate concentration of men in the upper quartiles and/or women in the lower quartiles can drive
-                a positive gender pay gap.
-                Average Total Remuneration
-                Total Workforce
-                22.0
-                78.0
-                $183,902
-                Upper Quartile
-                15.8
-                84.2
-                $288,066
-                Upper Middle Quartile
-                15.3
-                84.7
-                $186,896
-                Lower Middle Quartile
-                21.7
-                78.3
-                $153,332
-                Lower Quartile
-                35.3
-                64.7
-                $107,318
-                0%
-                20%
-                40%
-                60%
-                80%
-                Women
-                Men
-                Note: Part-time/casuals/part-year employee remuneration is annualised to full-time equivalent.
-                Gender pay gap and composition by occupational
-                group
-                The chart below shows the average total remuneration gender pay gap and composition for manager
-                category and non-manager occupations in the Mining industry for 2022-23.
-                The aspiration is to remove the gender pay gap in favour of men or women, so a gender pay gap closer to
-                zero is considered better.
-                Managers
-                Women
-                Men
-                Average total
-                remuneration GPG
-                All Managers
-                23%
-                77%
-                3.7%
-                Key Management Personnel
-                23%
-                77%
-                0.4%
-                Other Executives/General Managers
-                23%
-                77%
-                0.2%
-                Senior Managers
-                25%
-                75%
-                4.3%
-                Other Managers
-                23%
-                78%
-                6.1%
-                Non-managers
-                Women
-                Men
-                Average total
-                remuneration GPG
-                All non-Managers
-                22%
-                78%
-                15.2%
-                Clerical and Administrative Workers
-                72%
-                28%
-                22.0%
-                Community and Personal Service
-                Workers
-                34%
-                66%
-                7.8%
-                Sales Workers
-                23%
-                77%
-                N/A
-                Professionals
-                31%
-                69%
-                14.0%
-                Labourers
-                17%
-                83%
-                16.7%
-                Technicians and Trade Workers
-                10%
-                90%
-                20.9%
-                Machinery Operators and Drivers
-                18%
-                82%
-                12.5%
-                Note:
-                · Percentages shown may not add up to 100% due to rounding of decimal place.
-                · Gender pay gaps are not listed for manager/occupation categories when there are less than 100 women and men employees
-                in a category, or there are less than five submission groups in that employee manager/occupation category.
-                Workplace Gender Equality Agency | WGEA Mining Industry Snapshot | www.wgea.gov.au""",
-                    {
-                    "category_name": "Gender Pay Gap",
-                    "category_description": "Difference in average earnings between women and men in the workforce",
-                    "kpis": [
-                    {
-                        "kpi_name": "Average (mean) total remuneration",
-                        "unit": "percentage",
-                        "kpi_source": "WGEA Mining Industry Snapshot 2022-23",
-                        "kpi_description": "The average total remuneration gender pay gap in the mining industry.",
-                        "standard_values": [
-                        {
-                            "geographical_loc": "Australia",
-                            "country": "Australia",
-                            "industry": "Mining",
-                            "gender": "Women vs Men",
-                            "age_group": "All ages",
-                            "experience_level": "All experience levels",
-                            "value_avg": "12.7",
-                            "value_min": "12.7",
-                            "value_max": "14.2",
-                            "source_val": "WGEA Mining Industry Snapshot"
-                        }
-                        ]
-                    },
-                    {
-                        "kpi_name": "Median total remuneration",
-                        "unit": "percentage",
-                        "kpi_source": "WGEA Mining Industry Snapshot 2022-23",
-                        "kpi_description": "The median total remuneration gender pay gap in the mining industry.",
-                        "standard_values": [
-                        {
-                            "geographical_loc": "Australia",
-                            "country": "Australia",
-                            "industry": "Mining",
-                            "gender": "Women vs Men",
-                            "age_group": "All ages",
-                            "experience_level": "All experience levels",
-                            "value_avg": "15.1",
-                            "value_min": "15.1",
-                            "value_max": "16.6",
-                            "source_val": "WGEA Mining Industry Snapshot"
-                        }
-                        ]
-                    },
-                    {
-                        "kpi_name": "Average (mean) base salary",
-                        "unit": "percentage",
-                        "kpi_source": "WGEA Mining Industry Snapshot 2022-23",
-                        "kpi_description": "The average base salary gender pay gap in the mining industry.",
-                        "standard_values": [
-                        {
-                            "geographical_loc": "Australia",
-                            "country": "Australia",
-                            "industry": "Mining",
-                            "gender": "Women vs Men",
-                            "age_group": "All ages",
-                            "experience_level": "All experience levels",
-                            "value_avg": "9.9",
-                            "value_min": "9.9",
-                            "value_max": "11.9",
-                            "source_val": "WGEA Mining Industry Snapshot"
-                        }
-                        ]
-                    },
-                    {
-                        "kpi_name": "Median base salary",
-                        "unit": "percentage",
-                        "kpi_source": "WGEA Mining Industry Snapshot 2022-23",
-                        "kpi_description": "The median base salary gender pay gap in the mining industry.",
-                        "standard_values": [
-                        {
-                            "geographical_loc": "Australia",
-                            "country": "Australia",
-                            "industry": "Mining",
-                            "gender": "Women vs Men",
-                            "age_group": "All ages",
-                            "experience_level": "All experience levels",
-                            "value_avg": "12.3",
-                            "value_min": "12.3",
-                            "value_max": "14.7",
-                            "source_val": "WGEA Mining Industry Snapshot"
-                        }
-                        ]
-                    },
-                    {
-                        "kpi_name": "Average total remuneration by manager level",
-                        "unit": "percentage",
-                        "kpi_source": "WGEA Mining Industry Snapshot 2022-23",
-                        "kpi_description": "The average total remuneration gender pay gap for managers in the mining industry.",
-                        "standard_values": [
-                        {
-                            "geographical_loc": "Australia",
-                            "country": "Australia",
-                            "industry": "Mining",
-                            "gender": "Women vs Men",
-                            "age_group": "All ages",
-                            "experience_level": "Managers",
-                            "value_avg": "3.7",
-                            "value_min": "0.2",
-                            "value_max": "6.1",
-                            "source_val": "WGEA Mining Industry Snapshot"
-                        }
-                        ]
-                    },
-                    {
-                        "kpi_name": "Average total remuneration by non-manager level",
-                        "unit": "percentage",
-                        "kpi_source": "WGEA Mining Industry Snapshot 2022-23",
-                        "kpi_description": "The average total remuneration gender pay gap for non-managers in the mining industry.",
-                        "standard_values": [
-                        {
-                            "geographical_loc": "Australia",
-                            "country": "Australia",
-                            "industry": "Mining",
-                            "gender": "Women vs Men",
-                            "age_group": "All ages",
-                            "experience_level": "Non-managers",
-                            "value_avg": "15.2",
-                            "value_min": "7.8",
-                            "value_max": "22.0",
-                            "source_val": "WGEA Mining Industry Snapshot"
-                        }
-                        ]
-                    }
-                    ]
-                }
-                )
-            ]
-        )
+    Needs pypdf. Scanning the file for page objects is not reliable enough
+    to split on: it misses pages in compressed object streams and counts the
+    replaced pages of incrementally saved PDFs twice.
+    """
+    if pypdf is None:
+        return None
+    try:
+        return len(pypdf.PdfReader(file_path).pages)
+    except Exception as e:
+        log(f"pypdf could not read {file_path}: {str(e)}")
+        return None
 
-        # Create and execute extraction chain
-        chain = create_extraction_chain(llm, main_schema, encoder_or_encoder_class=JSONEncoder)  
-        output = chain.invoke(extracted_text)
-        
-        print("Raw extraction output:", json.dumps(output, indent=2))
-        
-        # Process extracted data
-        if output and isinstance(output, dict) and "data" in output:
-            data = output["data"]
-            
-            if isinstance(data, str):
-                print(f"Skipping string data: {data}")
-                return None
-                
-            # Process nested KPI_Category structure
-            if isinstance(data, dict):
-                if "KPI_Category" in data:
-                    data = data["KPI_Category"]
-                data_to_process = [data]
-            elif isinstance(data, list):
-                data_to_process = []
-                for item in data:
-                    if isinstance(item, dict) and "KPI_Category" in item:
-                        data_to_process.append(item["KPI_Category"])
-                    else:
-                        data_to_process.append(item)
+def page_ranges(page_count, size):
+    """Split pages 1..page_count into "first-last" ranges of at most size pages"""
+    if not page_count:
+        return []
+    return [f"{first}-{min(first + size - 1, page_count)}" for first in range(1, page_count + 1, size)]
+
+def shift_references(node, offset, counts):
+    """
+    Shift span offsets by offset and "/collection/index" element references by counts[collection], in place
+
+    Works on plain dicts as well as SDK models, which are mutable mappings keyed by REST names.
+    """
+    if isinstance(node, list):
+        for item in node:
+            shift_references(item, offset, counts)
+    elif isinstance(node, MutableMapping):
+        for key, value in node.items():
+            if key == "spans" and isinstance(value, list):
+                for span in value:
+                    span["offset"] += offset
+            elif key == "span" and isinstance(value, MutableMapping):
+                value["offset"] += offset
+            elif key == "elements" and isinstance(value, list):
+                node[key] = [
+                    f"/{parts[1]}/{int(parts[2]) + counts.get(parts[1], 0)}"
+                    if len(parts := element.split("/")) == 3 and parts[2].isdigit() else element
+                    for element in value
+                ]
             else:
-                print(f"Unexpected data type: {type(data)}")
-                return None
+                shift_references(value, offset, counts)
 
-            # Process each item in the extracted data
-            for item in data_to_process:
-                try:
-                    if not isinstance(item, dict):
-                        print(f"Skipping non-dictionary item: {item}")
-                        continue
-                        
-                    required_fields = ["category_name", "category_description", "kpis"]
-                    if not all(field in item for field in required_fields):
-                        print(f"Missing required fields in item: {item}")
-                        continue
-                        
-                    if not isinstance(item["kpis"], list):
-                        print(f"Invalid kpis structure in item: {item}")
-                        continue
-
-                    insert_result = insert_to_db(item, selected_categories)
-                    print(f"Database insertion result: {insert_result}")
-                    
-                except Exception as insert_error:
-                    print(f"Error inserting item into database: {str(insert_error)}")
-                    print(f"Item that caused error: {json.dumps(item, indent=2)}")
-                    continue
-            
-            return True
-            
-        else:
-            print("Invalid output structure")
-            print(f"Output: {json.dumps(output, indent=2)}")
-            return None
-            
-    except Exception as e:
-        print(f"Error in open_ai function: {str(e)}")
-        print(f"Full error details: {str(e.__class__.__name__)}: {str(e)}")
-        return None
+def stitch_results(parts):
+    """
+    Combine the analyze results of consecutive page ranges into one AnalyzeResult
+
+    Contents are joined with a newline, and spans and element references of
+    each part are shifted past the content and elements of the parts before it.
+    Page numbers are already absolute in ranged results. The parts are
+    modified in place rather than converted, as deserializing large results
+    is expensive.
+
+    Args:
+        parts (list): AnalyzeResults (or analyzeResult dicts) in page order
+    Returns:
+        AnalyzeResult: The stitched result
+    """
+    combined = parts[0]
+    for part in parts[1:]:
+        offset = len(combined.get("content", "")) + 1
+        counts = {key: len(combined.get(key) or []) for key, value in part.items() if isinstance(value, list)}
+        shift_references(part, offset, counts)
+        combined["content"] = combined.get("content", "") + "\n" + part.get("content", "")
+        for key, value in part.items():
+            if isinstance(value, list):
+                combined[key] = (combined.get(key) or []) + value
+    return combined if isinstance(combined, AnalyzeResult) else AnalyzeResult(combined)
 
-async def document_intelligence(file_path):
+async def analyze_layout(file_path, file_hash=None):
     """
-    Extract text from uploaded document using Azure Document Intelligence
-    
+    Analyze uploaded document with the Azure Document Intelligence layout model
+
+    The file is streamed to the service rather than read into memory. PDFs
+    longer than DI_PAGE_RANGE_SIZE pages are analysed as concurrent page ranges.
+
     Args:
         file_path (str): Path to the uploaded file
+        file_hash (str): SHA-256 of the file if already known (see save_upload)
     Returns:
-        str: Extracted text from the document
+        AnalyzeResult: Pages, lines, paragraphs and tables of the document
     """
     try:
-        credential = AzureKeyCredential(key)
-        client = DocumentIntelligenceClient(endpoint=endpoint, credential=credential)
+        client = get_document_client()
         
         # Verify file type
         content_type, _ = mimetypes.guess_type(file_path)
         if not content_type:
             raise ValueError("Unsupported file type")
 
-        # Read file and process with Document Intelligence
-        async with aiofiles.open(file_path, "rb") as file:
-            file_data = await file.read()
-            
-        poller = client.begin_analyze_document("prebuilt-layout", body=file_data)
-        result = poller.result()
-        
-        # Extract text from all pages
-        extracted_text = "\n".join([line.content for page in result.pages for line in page.lines])
-        return extracted_text
+        # Identical content analysed by the same model is served from the cache
+        file_hash = file_hash or await asyncio.to_thread(hash_file, file_path)
+        cache_key = f"{documentintelligence_model}-{file_hash}"
+        cached = await asyncio.to_thread(document_cache.get, cache_key)
+        if cached is not None:
+            result = AnalyzeResult(cached)
+            metrics.inc("document_pages_analyzed_total", len(result.pages), source="cache")
+            return result
+
+        # Poll without blocking the event loop, within the document_service limits
+        async def analyze(pages=None):
+            with time_stage("document_intelligence"):
+                with open(file_path, "rb") as file:
+                    poller = await client.begin_analyze_document(
+                        documentintelligence_model,
+                        body=file,
+                        pages=pages,
+                        content_type="application/octet-stream",
+                        polling_interval=documentintelligence_polling_interval
+                    )
+                return await poller.result()
+
+        ranges = []
+        if di_page_range_size and content_type == "application/pdf":
+            ranges = page_ranges(await asyncio.to_thread(pdf_page_count, file_path), di_page_range_size)
+
+        if len(ranges) > 1:
+            # Large PDFs: analyse page ranges concurrently and stitch them in order
+            fan_out = asyncio.Semaphore(di_range_fan_out)
+
+            async def analyze_range(pages):
+                async with fan_out:
+                    return await document_service.call(lambda: analyze(pages))
+
+            result = stitch_results(await asyncio.gather(*[analyze_range(pages) for pages in ranges]))
+        else:
+            result = await document_service.call(analyze)
+        metrics.inc("document_pages_analyzed_total", len(result.pages), source="service")
+
+        await asyncio.to_thread(document_cache.put, cache_key, result.as_dict())
+        return result
     except Exception as e:
-        print(f"Error in document_intelligence: {str(e)}")
+        log(f"Error in document_intelligence: {str(e)}")
         raise
 
-
 # upload file blob storage, used async as we need ability to serve several request simultanusly
 # async def upload_to_blob_storage(file_path, file_name):
 #     """Uploads a file to Azure Blob Storage asynchronously."""
@@ -650,14 +2432,352 @@ async def document_intelligence(file_path):
 #     except Exception as e:
 #         return f"Error uploading to Azure Blob Storage: {str(e)}"
 
+class JobStore:
+    """
+    Records of background upload jobs
+
+    Records are kept in memory, up to JOB_HISTORY_SIZE finished ones; with a
+    SQLite path they are persisted there instead, so /jobs/<id> works from
+    every worker and unfinished jobs are resumed after a restart. Persisted
+    jobs are leased by the worker running them (owner, lease_until), so a
+    job is only resumed elsewhere once its worker stopped renewing the lease.
+    """
+
+    def __init__(self, path=None):
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, status TEXT, record TEXT, updated REAL, "
+                "owner TEXT, lease_until REAL)"
+            )
+            # Job databases created before leases
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            self.connection.commit()
+
+    def save(self, job):
+        with self.lock:
+            if self.connection:
+                # A job claimed by another worker after this one lost its lease is left to that worker
+                now = time.time()
+                self.connection.execute(
+                    "INSERT INTO jobs (job_id, status, record, updated, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, record = excluded.record, "
+                    "updated = excluded.updated, lease_until = excluded.lease_until WHERE owner = excluded.owner",
+                    (job["id"], job["status"], json.dumps(job), now, self.worker_id, now + job_lease_seconds)
+                )
+                self.connection.commit()
+                return
+            self.jobs[job["id"]] = job
+            self.jobs.move_to_end(job["id"])
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently updated finished jobs beyond JOB_HISTORY_SIZE"""
+        if len(self.jobs) <= job_history_size:
+            return
+        finished = [
+            job_id for job_id, job in self.jobs.items() if job["status"] in ("succeeded", "failed")
+        ]
+        for job_id in finished[:max(0, len(finished) - job_history_size)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            if self.connection:
+                row = self.connection.execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                return json.loads(row[0]) if row else None
+            return self.jobs.get(job_id)
+
+    def renew(self):
+        """Extend the lease of the unfinished jobs of this worker"""
+        with self.lock:
+            if not self.connection:
+                return
+            self.connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                (time.time() + job_lease_seconds, self.worker_id)
+            )
+            self.connection.commit()
+
+    def claim_expired(self):
+        """
+        Take over unfinished jobs whose lease expired, e.g. after their worker stopped
+
+        Each job is claimed with a conditional UPDATE, so of several workers
+        resuming at once exactly one gets it.
+
+        Returns:
+            list: Claimed job records
+        """
+        with self.lock:
+            if not self.connection:
+                return []
+            now = time.time()
+            expired = "status IN ('queued', 'running') AND (lease_until IS NULL OR lease_until < ?)"
+            rows = self.connection.execute(
+                f"SELECT job_id, record FROM jobs WHERE {expired} ORDER BY updated", (now,)
+            ).fetchall()
+            claimed = []
+            for job_id, record in rows:
+                cursor = self.connection.execute(
+                    f"UPDATE jobs SET owner = ?, lease_until = ? WHERE job_id = ? AND {expired}",
+                    (self.worker_id, now + job_lease_seconds, job_id, now)
+                )
+                self.connection.commit()
+                if cursor.rowcount:
+                    claimed.append(json.loads(record))
+            return claimed
+
+    def close(self):
+        if self.connection:
+            # Release the leases so the next worker resumes these jobs right away
+            self.connection.execute(
+                "UPDATE jobs SET lease_until = NULL WHERE owner = ? AND status IN ('queued', 'running')",
+                (self.worker_id,)
+            )
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+# Pipeline stages run by the background workers, in order
+job_stages = ("analyze", "extract", "store")
+job_store = None
+job_queues = {}
+job_workers = []
+# In-flight stage outputs (layout chunks, extracted items) per job id
+job_payloads = {}
+
+def create_job(file_path, filename, selected_categories, file_hash=None, document=None):
+    """
+    Create a queued job record for an uploaded file
+
+    Uploads with the same explicit document name are revisions of one stored
+    document, see run_job_stage(); without one every upload is a new document.
+    """
+    job_id = uuid.uuid4().hex
+    return {
+        "id": job_id,
+        "filename": filename,
+        "document": document or f"{filename[:200]}#{job_id}",
+        "file_path": file_path,
+        "file_hash": file_hash,
+        "categories": list(selected_categories),
+        "status": "queued",
+        "stage": job_stages[0],
+        "stages": {stage: {"status": "pending", "started": None, "finished": None} for stage in job_stages},
+        "error": None,
+        "tokens": None,
+        "pages": None,
+        "created": time.time(),
+        "trace_id": current_trace_id.get(),
+    }
+
+async def save_job(job):
+    await asyncio.to_thread(job_store.save, job)
+
+async def enqueue_job(job):
+    """Persist a job and hand it to the first pipeline stage"""
+    await save_job(job)
+    await job_queues[job_stages[0]].put(job)
+
+async def run_job_stage(stage, job):
+    """
+    Run one pipeline stage for a job
+
+    analyze compares the page fingerprints with the stored revision of the
+    document and keeps only new or changed pages, plus the pages of stored
+    chunks that read one of them; extract sends those to the
+    LLM once per selected main category; store replaces the rows extracted
+    from the changed and removed pages, writing each result under its own
+    category, and records the new fingerprints.
+
+    Returns:
+        bool: True if the job should continue with the next stage
+    """
+    payload = job_payloads.setdefault(job["id"], {})
+    if stage == "analyze":
+        layout = await analyze_layout(job["file_path"], job.get("file_hash"))
+        fingerprints = page_fingerprints(layout, job["categories"])
+        document_id, stored = await asyncio.to_thread(load_document, job["document"])
+        changed = {
+            page_number for page_number, fingerprint in fingerprints.items()
+            if not incremental_extraction or stored.get(page_number) != fingerprint
+        }
+        removed = set(stored) - set(fingerprints)
+        metrics.inc("pages_unchanged_total", len(fingerprints) - len(changed))
+        job["pages"] = {"total": len(fingerprints), "changed": len(changed), "removed": len(removed)}
+        payload.update(document_id=document_id, fingerprints=fingerprints, dropped_pages=changed | removed)
+        # Unchanged pages sharing a chunk with a changed one lose their rows with it
+        stale = await asyncio.to_thread(extraction_pages, document_id, changed | removed)
+        extract_pages = changed | (stale & set(fingerprints))
+
+        selected = select_pages(layout, job["categories"])
+        pages = extract_pages if selected is None else selected & extract_pages
+        _, handled_tables = table_items(layout, pages, job["filename"])
+        payload["table_items"] = [
+            (group, {region.page_number for region in layout.tables[index].bounding_regions or []}, item)
+            for index, item in handled_tables.items()
+            for group in match_groups(
+                f"{item.category_description}\n{table_to_markdown(layout.tables[index])}", job["categories"]
+            )
+        ]
+        payload["chunks"] = chunk_layout(layout, pages=pages, handled_tables=handled_tables, with_pages=True)
+        log(f"Job {job['id']}: {len(changed)} of {len(fingerprints)} pages new or changed, kept {len(pages)}, "
+            f"mapped {len(handled_tables)} tables directly, split the rest into {len(payload['chunks'])} chunks")
+    elif stage == "extract":
+        job["tokens"] = new_token_report()
+        chunks = payload["chunks"]
+        chunk_items = await extract_chunk_items([text for text, _ in chunks], job["categories"]) if chunks else []
+        log(f"Job {job['id']}: {job['tokens']}")
+        page_items = payload["table_items"] + [
+            (group, pages, item)
+            for (_, pages), by_group in zip(chunks, chunk_items)
+            for group, items in by_group.items()
+            for item in items or []
+        ]
+        # Unchanged revisions have nothing to extract
+        if (chunks or payload["table_items"]) and not page_items:
+            raise ValueError("No data was extracted from the file")
+
+        # Merge the items per category group and set of source pages, so every
+        # stored row lands under its own category and can be traced back to
+        # the pages it came from
+        by_pages = {}
+        for group, pages, item in page_items:
+            by_pages.setdefault((group, frozenset(pages)), []).append(item)
+        payload["items"] = [(group, pages, merge_extractions(items)) for (group, pages), items in by_pages.items()]
+    elif stage == "store":
+        document_id = payload["document_id"]
+        await asyncio.to_thread(drop_page_rows, document_id, payload["dropped_pages"])
+        results = []
+        for group, pages, items in payload["items"]:
+            results += await asyncio.to_thread(store_items, items, list(group), document_id, pages)
+        errors = [result for result in results if result != "Success"]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        # Only a fully stored revision becomes the baseline for the next one
+        await asyncio.to_thread(save_document_pages, document_id, job.get("file_hash"), payload["fingerprints"])
+    return True
+
+async def job_worker(stage):
+    """Take jobs from the stage queue, run the stage and pass them on"""
+    queue = job_queues[stage]
+    next_stage = job_stages[job_stages.index(stage) + 1] if stage != job_stages[-1] else None
+    while True:
+        job = await queue.get()
+        current_trace_id.set(job.get("trace_id"))
+        try:
+            job["status"] = "running"
+            job["stage"] = stage
+            job["stages"][stage].update(status="running", started=time.time())
+            await save_job(job)
+
+            await run_job_stage(stage, job)
+
+            job["stages"][stage].update(status="done", finished=time.time())
+            metrics.observe(
+                "job_stage_duration_seconds", job["stages"][stage]["finished"] - job["stages"][stage]["started"],
+                stage=stage
+            )
+            if next_stage:
+                await save_job(job)
+                await job_queues[next_stage].put(job)
+            else:
+                job["status"] = "succeeded"
+                job_payloads.pop(job["id"], None)
+                await save_job(job)
+        except Exception as e:
+            log(f"Error in job {job['id']} at stage {stage}: {str(e)}")
+            job["stages"][stage].update(status="failed", finished=time.time())
+            job["status"] = "failed"
+            job["error"] = str(e)
+            job_payloads.pop(job["id"], None)
+            await save_job(job)
+        finally:
+            queue.task_done()
+
+async def start_job_workers():
+    """Start the configured workers per stage and resume unfinished persisted jobs"""
+    global job_store
+    job_store = JobStore(job_db_path if job_queue_backend == "sqlite" else None)
+    for stage in job_stages:
+        job_queues[stage] = asyncio.Queue()
+        for _ in range(job_stage_workers[stage]):
+            job_workers.append(asyncio.create_task(job_worker(stage)))
+
+    await resume_jobs()
+    if job_store.connection:
+        job_workers.append(asyncio.create_task(renew_job_leases()))
+
+async def resume_jobs():
+    """Re-enqueue the persisted unfinished jobs whose lease expired"""
+    for job in await asyncio.to_thread(job_store.claim_expired):
+        log(f"Resuming job {job['id']} ({job['filename']})")
+        resumed = create_job(
+            job["file_path"], job["filename"], job["categories"], job.get("file_hash"), job.get("document")
+        )
+        resumed.update(id=job["id"], created=job["created"], trace_id=job.get("trace_id"))
+        await enqueue_job(resumed)
+
+async def renew_job_leases():
+    """Renew this worker's job leases and take over jobs of workers that stopped renewing theirs"""
+    while True:
+        await asyncio.sleep(job_lease_seconds / 3)
+        try:
+            await asyncio.to_thread(job_store.renew)
+            await resume_jobs()
+        except Exception as e:
+            log(f"Error in renewing job leases: {str(e)}")
+
+async def stop_job_workers():
+    """Cancel the workers; persisted unfinished jobs resume on next start"""
+    for worker in job_workers:
+        worker.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    job_workers.clear()
+    job_queues.clear()
+    if job_store is not None:
+        job_store.close()
+
+@app.before_request
+async def start_request_trace():
+    """Start the request timer and, with TRACE_IDS, adopt X-Request-ID or a new trace id"""
+    request.started = time.perf_counter()
+    if trace_ids_enabled:
+        current_trace_id.set(request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16])
+
+@app.after_request
+async def finish_request_trace(response):
+    """Record request latency per endpoint and echo the trace id"""
+    started = getattr(request, "started", None)
+    if started is not None:
+        metrics.observe(
+            "http_request_duration_seconds", time.perf_counter() - started,
+            endpoint=request.endpoint or "unknown", method=request.method
+        )
+    trace_id = current_trace_id.get()
+    if trace_id:
+        response.headers["X-Request-ID"] = trace_id
+    return response
+
 selected_categories=[]
 @app.route('/', methods=['GET', 'POST'])
 async def upload_file():
     """
     Handle file upload and processing
     GET: Display upload form
-    POST: Process uploaded file and extract KPIs
+    POST: Save uploaded file and queue a job that extracts its KPIs
     """
+    categories = ['Demographic', 'Performance Data', 'Leave Policies', 'Salary Information']
     if request.method == 'POST':
         try:
             # Get form data and file
@@ -673,125 +2793,430 @@ async def upload_file():
             if not selected_categories:
                 return await render_template('upload.html', error="Please select at least one category")
 
-            # Save and process file
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            await file.save(file_path)
+            # Stream the file to disk, then name it by its content hash so
+            # concurrent uploads with the same name do not overwrite each other
+            filename = secure_filename(file.filename) or "upload"
+            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.part")
+            with time_stage("upload_save"):
+                file_hash = await save_upload(file, temp_path)
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_hash[:16]}-{filename}")
+            os.replace(temp_path, file_path)
 
-            # Extract text and process with OpenAI
-            extracted_text = await document_intelligence(file_path)
-            print(extracted_text)
-            result = await open_ai(extracted_text, selected_categories)
-            
-            if result:
-                return redirect(url_for('show_data'))
-            else:
-                return await render_template('upload.html', error="No data was extracted from the file")
+            # Analysis, extraction and insertion run in the background job workers
+            # Uploads naming a stored document replace its changed pages
+            document = (form.get('document') or '').strip() or None
+            job = create_job(file_path, filename, selected_categories, file_hash, document)
+            await enqueue_job(job)
+
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({"job_id": job["id"], "status_url": url_for('job_status', job_id=job["id"])}), 202
+            return await render_template('upload.html', categories=categories, job_id=job["id"])
                 
         except Exception as e:
-            print(f"Error processing file: {str(e)}")
+            log(f"Error processing file: {str(e)}")
             return await render_template('upload.html', error=f"Error: {str(e)}")
 
     # Display upload form with available categories
-    categories = ['Demographic', 'Performance Data', 'Leave Policies', 'Salary Information']
     return await render_template('upload.html', categories=categories)
 
-def fetch_all_data():
+@app.route('/jobs/<job_id>')
+async def job_status(job_id):
+    """
+    Route handler reporting the status and per-stage progress of an upload job
+    """
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify({key: value for key, value in job.items() if key != "file_path"})
+
+# Filters accepted by /show_data, mapped to the columns they apply to
+data_filters = {
+    "category": kpis_category_table.c.maincat_id,
+    "country": standard_values_table.c.country,
+    "industry": standard_values_table.c.industry,
+    "gender": standard_values_table.c.gender,
+}
+
+def filter_conditions(filters, names):
+    """SQL conditions for the non-empty filters among names"""
+    conditions = []
+    for name in names:
+        value = (filters or {}).get(name)
+        if not value:
+            continue
+        if name == "category":
+            value = category_mapping.get(value, -1)
+        conditions.append(data_filters[name] == value)
+    return conditions
+
+def standard_values_query(filters=None):
+    """Select standard values matching the category/country/industry/gender filters"""
+    sv = standard_values_table
+    query = db.select(*sv.c)
+    if (filters or {}).get("category"):
+        query = query.join(kpis_table, kpis_table.c.kpi_id == sv.c.kpi_id).join(
+            kpis_category_table, kpis_category_table.c.cat_id == kpis_table.c.category_id
+        )
+    return query.where(*filter_conditions(filters, data_filters))
+
+def parse_cursor(value):
+    """(kpi_id, standard_val_id) from a "kpi_id-standard_val_id" page cursor, (0, 0) for the first page"""
+    try:
+        kpi_id, standard_val_id = (int(part) for part in (value or "0-0").split("-"))
+        return kpi_id, standard_val_id
+    except ValueError:
+        return 0, 0
+
+def fetch_all_data(filters=None, after=(0, 0), page_size=None):
     """
-    Fetch all KPI data from the database
-    
+    Fetch one page of KPI data from the database as a category -> KPI -> value tree
+
+    KPIs are outer-joined to their standard values and paged by keyset on
+    (kpi_id, standard_val_id), a KPI without values counting as value 0.
+    Country, industry and gender filters keep only the matching values;
+    without them KPIs without values are listed too, and the first page
+    also lists the categories without KPIs. The tree is built in one pass
+    over the rows, which are kept as compact row tuples.
+
+    Args:
+        filters (dict): Optional category (main category name), country, industry and gender
+        after (tuple): (kpi_id, standard_val_id) of the last row of the previous page, see parse_cursor
+        page_size (int): Rows (standard values or KPIs without values) per page, defaults to SHOW_DATA_PAGE_SIZE
     Returns:
-        dict: Dictionary containing data from all tables
+        dict: Main categories, the category tree and the next page cursor
     """
+    filters = filters or {}
+    page_size = page_size or show_data_page_size
+    after_kpi_id, after_value_id = after
     try:
         engine = get_engine()
         with Session(engine) as session:
-            # Fetch data from all tables
             main_categories = session.execute(
                 text("SELECT * FROM main_category")
             ).all()
-            
-            kpi_categories = session.execute(
-                text("""
-                    SELECT 
-                        cat_id,
-                        cat_name,
-                        cat_description,
-                        maincat_id
-                    FROM kpis_category
-                """)
-            ).all()
-            
-            kpis = session.execute(
-                text("""
-                    SELECT 
-                        kpi_id,
-                        category_id,
-                        kpi_name,
-                        unit,
-                        kpi_source,
-                        kpi_description
-                    FROM kpis
-                """)
-            ).all()
-            
-            standard_values = session.execute(
-                text("""
-                    SELECT 
-                        kpi_id,
-                        geographical_loc,
-                        country,
-                        industry,
-                        gender,
-                        age_group,
-                        experience_level,
-                        value_avg,
-                        value_min,
-                        value_max,
-                        source_val
-                    FROM standard_values
-                """)
-            ).all()
-            
-            # Convert results to dictionaries
+
+            # Page of KPIs with their category and standard values
+            sv, k, c = standard_values_table, kpis_table, kpis_category_table
+            value_conditions = filter_conditions(filters, ("country", "industry", "gender"))
+            value_id = db.func.coalesce(sv.c.standard_val_id, 0)
+            query = (
+                db.select(
+                    sv.c.standard_val_id,
+                    k.c.kpi_id,
+                    sv.c.geographical_loc,
+                    sv.c.country,
+                    sv.c.industry,
+                    sv.c.gender,
+                    sv.c.age_group,
+                    sv.c.experience_level,
+                    sv.c.value_avg,
+                    sv.c.value_min,
+                    sv.c.value_max,
+                    sv.c.source_val,
+                    k.c.category_id,
+                    k.c.kpi_name,
+                    k.c.unit,
+                    k.c.kpi_source,
+                    k.c.kpi_description,
+                    c.c.cat_name,
+                    c.c.cat_description,
+                    c.c.maincat_id
+                )
+                .select_from(
+                    k.join(c, c.c.cat_id == k.c.category_id)
+                    .outerjoin(sv, db.and_(sv.c.kpi_id == k.c.kpi_id, *value_conditions))
+                )
+                .where(
+                    k.c.kpi_id >= after_kpi_id,
+                    db.or_(k.c.kpi_id > after_kpi_id, value_id > after_value_id),
+                    *filter_conditions(filters, ("category",))
+                )
+                .order_by(k.c.kpi_id, sv.c.standard_val_id)
+                .limit(page_size + 1)
+            )
+            if value_conditions:
+                query = query.where(sv.c.standard_val_id.is_not(None))
+            rows = session.execute(query).all()
+
+            next_after = None
+            if len(rows) > page_size:
+                rows = rows[:page_size]
+                next_after = f"{rows[-1].kpi_id}-{rows[-1].standard_val_id or 0}"
+
+            # Group rows by category and KPI in first-seen order
+            categories = {}
+            kpis = {}
+            for row in rows:
+                kpi = kpis.get(row.kpi_id)
+                if kpi is None:
+                    category = categories.get(row.category_id)
+                    if category is None:
+                        category = categories[row.category_id] = {"category": row, "kpis": []}
+                    kpi = kpis[row.kpi_id] = {"kpi": row, "values": []}
+                    category["kpis"].append(kpi)
+                if row.standard_val_id is not None:
+                    kpi["values"].append(row)
+
+            if not value_conditions and after == (0, 0):
+                empty_categories = session.execute(
+                    db.select(
+                        c.c.cat_id.label("category_id"), c.c.cat_name, c.c.cat_description, c.c.maincat_id
+                    )
+                    .where(~db.exists().where(k.c.category_id == c.c.cat_id), *filter_conditions(filters, ("category",)))
+                    .order_by(c.c.cat_id)
+                )
+                for row in empty_categories:
+                    categories[row.category_id] = {"category": row, "kpis": []}
+
             return {
                 'main_categories': [
                     {column: value for column, value in row._mapping.items()}
                     for row in main_categories
                 ],
-                'kpi_categories': [
-                    {column: value for column, value in row._mapping.items()}
-                    for row in kpi_categories
-                ],
-                'kpis': [
-                    {column: value for column, value in row._mapping.items()}
-                    for row in kpis
-                ],
-                'standard_values': [
-                    {column: value for column, value in row._mapping.items()}
-                    for row in standard_values
-                ]
+                'categories': list(categories.values()),
+                'next_after': next_after
             }
             
     except Exception as e:
-        print(f"Error fetching data: {str(e)}")
+        log(f"Error fetching data: {str(e)}")
         import traceback
-        print(traceback.format_exc())
+        log(traceback.format_exc())
         return None
 
+# In-process LRU of rendered pages, backed by an optional shared on-disk cache
+show_data_pages = OrderedDict()
+show_data_pages_lock = threading.Lock()
+show_data_disk_cache = DiskCache(show_data_cache_dir, show_data_cache_max_bytes, 24 * 3600)
+
+def get_cached_page(etag):
+    with show_data_pages_lock:
+        page = show_data_pages.get(etag)
+        if page is not None:
+            show_data_pages.move_to_end(etag)
+            return page
+    page = show_data_disk_cache.get(etag)
+    if page is not None:
+        cache_page(etag, page, shared=False)
+    return page
+
+def cache_page(etag, page, shared=True):
+    with show_data_pages_lock:
+        show_data_pages[etag] = page
+        show_data_pages.move_to_end(etag)
+        while len(show_data_pages) > show_data_cache_size:
+            show_data_pages.popitem(last=False)
+    if shared:
+        show_data_disk_cache.put(etag, page)
+
 @app.route('/show_data')
 async def show_data():
     """
-    Route handler for displaying all KPI data
+    Route handler for displaying KPI data one page at a time
+
+    Query parameters: category, country, industry, gender, after (cursor) and page_size.
+    Rendered pages are cached per data generation and served with an ETag,
+    so unchanged pages are answered with 304 Not Modified.
     """
     try:
-        all_data = fetch_all_data()
-        if all_data:
-            return await render_template('show_data.html', data=all_data)
-        else:
-            return await render_template('show_data.html', error="No data available")
+        filters = {name: request.args.get(name, "").strip() for name in data_filters}
+        after = parse_cursor(request.args.get("after"))
+        page_size = min(request.args.get("page_size", show_data_page_size, type=int), show_data_max_page_size)
+
+        generation = await asyncio.to_thread(get_data_generation)
+        page_key = json.dumps([generation, filters, after, page_size], sort_keys=True)
+        etag = hashlib.sha256(page_key.encode()).hexdigest()[:32]
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+        page = await asyncio.to_thread(get_cached_page, etag)
+        if page is None:
+            all_data = await asyncio.to_thread(fetch_all_data, filters, after, max(page_size, 1))
+            if not all_data:
+                return await render_template('show_data.html', error="No data available", filters=filters,
+                                             categories=list(category_mapping))
+            page = await render_template(
+                'show_data.html',
+                data=all_data,
+                filters=filters,
+                categories=list(category_mapping),
+                page_size=page_size,
+                after_id=after != (0, 0)
+            )
+            await asyncio.to_thread(cache_page, etag, page)
+
+        return Response(page, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
     except Exception as e:
-        return await render_template('show_data.html', error=f"Error: {str(e)}")
+        return await render_template('show_data.html', error=f"Error: {str(e)}", filters={},
+                                     categories=list(category_mapping))
+
+def iter_row_batches(query, batch_size=None):
+    """
+    Yield batches of rows from a server-side cursor
+
+    Only one batch of API_BATCH_SIZE rows is held in memory at a time.
+    """
+    with Session(get_engine()) as session:
+        result = session.execute(
+            query, execution_options={"stream_results": True, "yield_per": batch_size or api_batch_size}
+        )
+        for partition in result.partitions():
+            yield partition
+
+def iter_nested_kpis(filters=None):
+    """
+    Yield one dict per KPI with its category and its standard values nested
+
+    Rows come from a single join ordered by KPI, so only the current KPI is
+    held in memory. Value filters narrow the nested values, the category
+    filter narrows the KPIs.
+    """
+    sv = standard_values_table
+    query = (
+        db.select(
+            kpis_category_table.c.cat_id,
+            kpis_category_table.c.cat_name,
+            kpis_category_table.c.cat_description,
+            kpis_category_table.c.maincat_id,
+            *kpis_table.c,
+            *[column.label(f"sv_{column.name}") for column in sv.c]
+        )
+        .select_from(
+            kpis_table
+            .join(kpis_category_table, kpis_category_table.c.cat_id == kpis_table.c.category_id)
+            .outerjoin(sv, db.and_(
+                sv.c.kpi_id == kpis_table.c.kpi_id,
+                *filter_conditions(filters, ("country", "industry", "gender"))
+            ))
+        )
+        .where(*filter_conditions(filters, ("category",)))
+        .order_by(kpis_table.c.kpi_id, sv.c.standard_val_id)
+    )
+    kpi_columns = ("cat_id", "cat_name", "cat_description", "maincat_id") + tuple(kpis_table.c.keys())
+    value_columns = [(f"sv_{name}", name) for name in sv.c.keys()]
+
+    current = None
+    for batch in iter_row_batches(query):
+        for row in batch:
+            mapping = row._mapping
+            if current is None or current["kpi_id"] != mapping["kpi_id"]:
+                if current is not None:
+                    yield current
+                current = {name: mapping[name] for name in kpi_columns}
+                current["standard_values"] = []
+            if mapping["sv_standard_val_id"] is not None:
+                current["standard_values"].append({name: mapping[label] for label, name in value_columns})
+    if current is not None:
+        yield current
+
+def iter_flat_rows(query):
+    """Yield one dict per row of query"""
+    for batch in iter_row_batches(query):
+        for row in batch:
+            yield row._asdict()
+
+async def ndjson_lines(records):
+    """
+    Serialise a blocking record iterator as NDJSON without blocking the event loop
+
+    Records are pulled from the database in a worker thread and sent in
+    groups of API_BATCH_SIZE lines.
+    """
+    finished = object()
+
+    def next_lines():
+        lines = []
+        for record in records:
+            lines.append(json.dumps(record, default=str) + "\n")
+            if len(lines) >= api_batch_size:
+                break
+        return "".join(lines) if lines else finished
+
+    try:
+        while True:
+            lines = await asyncio.to_thread(next_lines)
+            if lines is finished:
+                break
+            yield lines
+    finally:
+        await asyncio.to_thread(records.close)
+
+def ndjson_response(records):
+    response = Response(ndjson_lines(records), mimetype="application/x-ndjson")
+    response.timeout = None
+    return response
+
+@app.route('/api/kpis')
+async def api_kpis():
+    """
+    Stream KPIs as NDJSON
+
+    Query parameters: category, and with nested=1 also country, industry and
+    gender to filter the standard values nested under each KPI.
+    """
+    filters = {name: request.args.get(name, "").strip() for name in data_filters}
+    if request.args.get("nested", "").lower() in ("1", "true", "yes"):
+        return ndjson_response(iter_nested_kpis(filters))
+
+    query = (
+        db.select(*kpis_table.c, kpis_category_table.c.cat_name, kpis_category_table.c.maincat_id)
+        .join(kpis_category_table, kpis_category_table.c.cat_id == kpis_table.c.category_id)
+        .where(*filter_conditions(filters, ("category",)))
+        .order_by(kpis_table.c.kpi_id)
+    )
+    return ndjson_response(iter_flat_rows(query))
+
+@app.route('/api/standard_values')
+async def api_standard_values():
+    """
+    Stream standard values as NDJSON
+
+    Query parameters: category, country, industry, gender
+    """
+    filters = {name: request.args.get(name, "").strip() for name in data_filters}
+    query = standard_values_query(filters).order_by(standard_values_table.c.standard_val_id)
+    return ndjson_response(iter_flat_rows(query))
+
+@app.route('/stats')
+async def stats():
+    """
+    Route handler exposing runtime statistics as JSON
+    """
+    return {
+        "db_pool": get_pool_stats(),
+        "document_intelligence": document_service.stats(),
+        "llm": llm_service.stats(),
+        "document_cache": document_cache.stats(),
+        "extraction_cache": extraction_cache.stats(),
+        "show_data_cache": {**show_data_disk_cache.stats(), "pages": len(show_data_pages)},
+    }
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    """
+    Route handler exposing stage latency histograms and counters in the Prometheus text format
+    """
+    pool = get_pool_stats()
+    gauges = [
+        ("db_pool_checked_out", {}, pool["checked_out"] or 0),
+        ("db_pool_overflow", {}, max(pool["overflow"] or 0, 0)),
+    ]
+    gauges += [("job_queue_depth", {"stage": stage}, queue.qsize()) for stage, queue in job_queues.items()]
+    gauges += [
+        ("service_concurrency_limit", {"service": service.name}, service.limiter.limit)
+        for service in (document_service, llm_service)
+    ]
+    return Response(metrics.render(gauges), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="HR KPI document analysis")
+    parser.add_argument(
+        "command", nargs="?", default="serve", choices=["serve", "compact"],
+        help="serve: run the web app (default); compact: collapse duplicate categories, KPIs and standard values"
+    )
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        print(f"Deleted duplicate rows: {compact_duplicates()}")
+    else:
+        app.run(debug=True)
 
@@ -0,0 +1,250 @@
+"""
+End-to-end benchmark of the Quart app without Azure.
+
+Starts the fake Document Intelligence and Azure OpenAI services, points the
+app at a fresh SQLite database, then drives it through its HTTP routes:
+uploads (followed until their job finishes) and /show_data and /api/kpis
+reads, each at the given concurrency. Reports count, p50/p95/p99 latency and
+throughput for the end-to-end uploads, every pipeline stage, every timed span
+(document_intelligence, llm, insert_to_db, ...) and every endpoint. With
+--memory, also the peak traced memory while each stage was running.
+
+Results can be saved and compared against a baseline, failing (exit code 1)
+when a p95 latency regresses by more than the tolerance.
+
+Usage:
+    python benchmarks/bench_e2e.py --uploads 40 --reads 200 --concurrency 8 --di-latency 0.5 --llm-latency 1
+    python benchmarks/bench_e2e.py --save baseline.json
+    python benchmarks/bench_e2e.py --compare baseline.json --tolerance 0.2
+"""
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+DI_PORT = 8731
+LLM_PORT = 8732
+
+tmp = tempfile.TemporaryDirectory()
+os.environ.update(
+    DOCUMENTINTELLIGENCE_ENDPOINT=f"http://127.0.0.1:{DI_PORT}",
+    DOCUMENTINTELLIGENCE_API_KEY="fake",
+    DOCUMENTINTELLIGENCE_POLLING_INTERVAL="0.05",
+    AZURE_OPENAI_ENDPOINT=f"http://127.0.0.1:{LLM_PORT}",
+    AZURE_OPENAI_API_KEY="fake",
+    OPENAI_API_VERSION="2024-08-01-preview",
+    DATABASE_URL=f"sqlite:///{os.path.join(tmp.name, 'bench.db')}",
+    JOB_QUEUE_BACKEND="memory",
+    DI_CACHE_DIR="",
+    LLM_CACHE_DIR="",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+import fake_services  # noqa: E402
+from bench_extraction import stub_response  # noqa: E402
+from quart.datastructures import FileStorage  # noqa: E402
+
+
+class Recorder:
+    """Collects raw durations per series and, with tracemalloc, peak memory per active stage"""
+
+    def __init__(self):
+        self.samples = {}
+        self.active = {}
+        self.peaks = {}
+
+    def add(self, series, value):
+        self.samples.setdefault(series, []).append(value)
+
+    def install(self):
+        """Record every metrics.observe() call and track running job stages"""
+        observe = app.metrics.observe
+        run_job_stage = app.run_job_stage
+
+        def recording_observe(name, value, **labels):
+            label = labels.get("stage") or labels.get("endpoint") or ""
+            self.add(f"{name.replace('_duration_seconds', '')}:{label}", value)
+            observe(name, value, **labels)
+
+        async def tracked_run_job_stage(stage, job):
+            self.active[stage] = self.active.get(stage, 0) + 1
+            try:
+                return await run_job_stage(stage, job)
+            finally:
+                self.active[stage] -= 1
+
+        app.metrics.observe = recording_observe
+        app.run_job_stage = tracked_run_job_stage
+
+    async def sample_memory(self, interval=0.01):
+        while True:
+            current, _ = tracemalloc.get_traced_memory()
+            for stage, count in self.active.items():
+                if count:
+                    self.peaks[stage] = max(self.peaks.get(stage, 0), current)
+            await asyncio.sleep(interval)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(recorder, wall_times):
+    """Per series: count, latency percentiles, throughput over its phase and peak memory"""
+    results = {}
+    for series, values in sorted(recorder.samples.items()):
+        phase = "read" if series.split(":")[-1] in ("show_data", "api_kpis") else "ingest"
+        stage = series.split(":")[-1]
+        results[series] = {
+            "count": len(values),
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+            "throughput": len(values) / wall_times[phase] if wall_times[phase] else None,
+            "peak_mb": recorder.peaks[stage] / 2 ** 20 if series.startswith("job_stage:") and stage in recorder.peaks else None,
+        }
+    return results
+
+
+def report(results, wall_times, peak_total):
+    print(f"\n{'series':<38} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'per s':>8} {'peak MB':>8}")
+    for series, result in results.items():
+        peak = f"{result['peak_mb']:8.1f}" if result["peak_mb"] is not None else f"{'':>8}"
+        print(f"{series:<38} {result['count']:>6} {result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} "
+              f"{result['p99'] * 1000:>9.1f} {result['max'] * 1000:>9.1f} {result['throughput'] or 0:>8.2f} {peak}")
+    print(f"\ningest phase {wall_times['ingest']:.2f}s, read phase {wall_times['read']:.2f}s"
+          + (f", peak traced memory {peak_total / 2 ** 20:.1f} MB" if peak_total else ""))
+
+
+def compare(results, baseline_path, tolerance):
+    """Return the series whose p95 is more than tolerance slower than in the baseline"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for series, result in results.items():
+        before = baseline.get(series)
+        if before and before["p95"] and result["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{series}: p95 {before['p95'] * 1000:.1f} -> {result['p95'] * 1000:.1f} ms")
+    return regressions
+
+
+async def run_pool(concurrency, count, func):
+    """Run func(i) for i in range(count) with at most concurrency calls in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i):
+        async with semaphore:
+            await func(i)
+
+    await asyncio.gather(*[bounded(i) for i in range(count)])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--reads", type=int, default=100, help="requests per read endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--di-latency", type=float, default=0.5)
+    parser.add_argument("--di-pages", type=int, default=3)
+    parser.add_argument("--di-tables", type=int, default=1)
+    parser.add_argument("--di-payload", help="JSON file with an analyzeResult to return instead")
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--llm-response", help="file with the assistant reply, defaults to the schema example")
+    parser.add_argument("--memory", action="store_true", help="trace memory and report peaks per stage (slower)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON from --save to check p95 latencies against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown against the baseline")
+    args = parser.parse_args()
+
+    payload = None
+    if args.di_payload:
+        with open(args.di_payload) as f:
+            payload = json.load(f)
+    response_text = stub_response()
+    if args.llm_response:
+        with open(args.llm_response) as f:
+            response_text = f.read()
+
+    app.app.config['UPLOAD_FOLDER'] = os.path.join(tmp.name, "uploads")
+    os.makedirs(app.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    runners = [
+        await fake_services.start_site(
+            fake_services.create_di_app(args.di_latency, payload, args.di_pages, tables=args.di_tables), DI_PORT
+        ),
+        await fake_services.start_site(fake_services.create_llm_app(response_text, args.llm_latency), LLM_PORT),
+    ]
+    recorder = Recorder()
+    recorder.install()
+    wall_times = {}
+    sampler = None
+    if args.memory:
+        tracemalloc.start()
+        sampler = asyncio.create_task(recorder.sample_memory())
+
+    try:
+        async with app.app.test_app() as test_app:
+            app.metadata.create_all(app.get_engine())
+            client = test_app.test_client()
+
+            async def upload(i):
+                start = time.perf_counter()
+                response = await client.post(
+                    "/", headers={"Accept": "application/json"}, form={"categories": "Salary Information"},
+                    files={"file": FileStorage(io.BytesIO(f"%PDF-1.4 report {i}".encode()), filename=f"report{i}.pdf")},
+                )
+                status_url = (await response.get_json())["status_url"]
+                while True:
+                    job = await (await client.get(status_url)).get_json()
+                    if job["status"] in ("succeeded", "failed"):
+                        break
+                    await asyncio.sleep(0.02)
+                if job["status"] == "failed":
+                    print(f"Upload {i} failed: {job['error']}")
+                recorder.add("upload_to_stored", time.perf_counter() - start)
+
+            async def read(i):
+                path = "/show_data" if i % 2 == 0 else "/api/kpis"
+                response = await client.get(f"{path}?page_size=100&after={i % 5}")
+                await response.get_data()
+
+            start = time.perf_counter()
+            await run_pool(args.concurrency, args.uploads, upload)
+            wall_times["ingest"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            await run_pool(args.concurrency, args.reads * 2, read)
+            wall_times["read"] = time.perf_counter() - start
+    finally:
+        if sampler:
+            sampler.cancel()
+        for runner in runners:
+            await runner.cleanup()
+
+    peak_total = tracemalloc.get_traced_memory()[1] if args.memory else None
+    if args.memory:
+        tracemalloc.stop()
+    # Job status polling is harness overhead, not app behaviour
+    recorder.samples.pop("http_request:job_status", None)
+    results = summarize(recorder, wall_times)
+    report(results, wall_times, peak_total)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": vars(args), "wall_times": wall_times, "results": results}, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+Measure LLM extraction throughput with a stubbed chat model.
+
+Compares the original open_ai path (client, schema and chain rebuilt per
+upload, chain.invoke called from the event loop) with the shared chain
+invoked through app.extract_kpis (ainvoke, bounded by LLM_CONCURRENCY),
+and prints the prompt size per few-shot example mode and per focused
+category schema.
+
+Usage:
+    python benchmarks/bench_extraction.py --requests 32 --latency 0.5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from kor.extraction import create_extraction_chain
+from kor.encoders import JSONEncoder
+
+# Measure the chain, not the on-disk extraction cache answering repeat runs
+os.environ.update(LLM_CACHE_DIR="")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+# Schema with every example in the examples file, as the original open_ai built it
+main_schema = app.build_main_schema(app.get_examples())
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model that waits `latency` seconds and answers with a fixed Kor payload"""
+
+    latency: float = 0.5
+    response: str = ""
+
+    @property
+    def _llm_type(self):
+        return "stub-chat-model"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+
+def stub_response():
+    """Kor-formatted answer built from the schema's own example"""
+    _, example_output = main_schema.examples[0]
+    return "<json>" + json.dumps({"KPI_Category": [example_output]}) + "</json>"
+
+
+async def per_request_sync_chain(llm, extracted_text):
+    """The original open_ai behaviour: build the chain per call and invoke it synchronously"""
+    chain = create_extraction_chain(llm, main_schema, encoder_or_encoder_class=JSONEncoder)
+    return chain.invoke(extracted_text)
+
+
+async def drive(name, func, request_count):
+    start = time.perf_counter()
+    outputs = await asyncio.gather(*[func(f"document {i}") for i in range(request_count)])
+    elapsed = time.perf_counter() - start
+    assert all(output["data"] for output in outputs)
+    print(f"{name:<22} {elapsed:7.2f} s  {request_count / elapsed:8.2f} requests/s")
+
+
+def prompt_tokens(text, mode, category=None):
+    chain, _ = app.get_extraction_chain(app.select_examples(text, mode, category), category)
+    return app.count_tokens(chain.first.format_prompt(text=text).to_string())
+
+
+def prompt_sizes(texts):
+    """Prompt tokens per KOR_EXAMPLES_MODE for each sample text, generic and per focused category"""
+    print(f"{'text':<16} {'all':>8} {'relevant':>9} {'none':>8}")
+    for name, text in texts.items():
+        counts = [prompt_tokens(text, mode) for mode in ("all", "relevant", "none")]
+        print(f"{name:<16} {counts[0]:>8} {counts[1]:>9} {counts[2]:>8}")
+
+    categories = list(app.category_focus)
+    print(f"\n{'text (all mode)':<16} {'generic':>8} " + " ".join(f"{category[:12]:>12}" for category in categories))
+    for name, text in texts.items():
+        counts = [prompt_tokens(text, "all", category) for category in categories]
+        print(f"{name:<16} {prompt_tokens(text, 'all'):>8} " + " ".join(f"{count:>12}" for count in counts))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.5, help="stubbed LLM latency in seconds")
+    args = parser.parse_args()
+
+    llm = StubChatModel(latency=args.latency, response=stub_response())
+    app.extraction_llm = llm
+    app.extraction_chains.clear()
+
+    await drive("per-request + invoke", lambda text: per_request_sync_chain(llm, text), args.requests)
+    await drive(f"shared + ainvoke ({app.llm_concurrency})", app.extract_kpis, args.requests)
+
+    example_text = app.get_examples()[0]["text"]
+    prompt_sizes({
+        "pay gap report": example_text[:2000],
+        "unrelated": "Quarterly maintenance schedule for the warehouse forklifts and loading docks.",
+    })
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
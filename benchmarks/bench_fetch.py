@@ -0,0 +1,110 @@
+"""
+Compare the original fetch_all_data (four full-table reads converted to
+dicts) with the joined, tree-building fetch_all_data on a seeded SQLite
+database.
+
+Usage:
+    python benchmarks/bench_fetch.py --values 1000000 --kpis 10000 --categories 100
+    python benchmarks/bench_fetch.py --db /tmp/kpis.db --memory
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import sqlalchemy as db
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def seed(engine, category_count, kpi_count, value_count):
+    """Fill an empty database with synthetic categories, KPIs and standard values (unique natural keys)"""
+    app.metadata.create_all(engine)
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT COUNT(*) FROM standard_values")).scalar() >= value_count:
+            return
+        conn.execute(db.insert(app.main_category_table), [
+            {"maincat_id": maincat_id, "main_category_name": name} for name, maincat_id in app.category_mapping.items()
+        ])
+        conn.execute(db.insert(app.kpis_category_table), [
+            {"cat_id": c + 1, "cat_name": f"Category {c}", "cat_description": "Synthetic",
+             "maincat_id": c % len(app.category_mapping) + 1}
+            for c in range(category_count)
+        ])
+        conn.execute(db.insert(app.kpis_table), [
+            {"kpi_id": k + 1, "category_id": k % category_count + 1, "kpi_name": f"KPI {k}", "unit": "percentage",
+             "kpi_source": "Synthetic", "kpi_description": "Synthetic KPI"}
+            for k in range(kpi_count)
+        ])
+        countries = ["Australia", "Germany", "Canada", "Japan"]
+        batch = 50000
+        for start in range(0, value_count, batch):
+            conn.execute(db.insert(app.standard_values_table), [
+                {"kpi_id": v % kpi_count + 1, "geographical_loc": "Global", "country": countries[v % 4],
+                 "industry": "Mining", "gender": "Women vs Men", "age_group": "All ages",
+                 "experience_level": "All", "value_avg": 12.5, "value_min": 9.9, "value_max": 14.2,
+                 "source_val": f"Synthetic {v}"}
+                for v in range(start, min(start + batch, value_count))
+            ])
+
+
+def original_fetch_all_data(engine):
+    """fetch_all_data as it was: four unbounded SELECTs, one dict per row"""
+    with Session(engine) as session:
+        tables = {
+            'main_categories': "SELECT * FROM main_category",
+            'kpi_categories': "SELECT cat_id, cat_name, cat_description, maincat_id FROM kpis_category",
+            'kpis': "SELECT kpi_id, category_id, kpi_name, unit, kpi_source, kpi_description FROM kpis",
+            'standard_values': "SELECT kpi_id, geographical_loc, country, industry, gender, age_group, "
+                               "experience_level, value_avg, value_min, value_max, source_val FROM standard_values",
+        }
+        return {
+            name: [{column: value for column, value in row._mapping.items()} for row in session.execute(text(sql)).all()]
+            for name, sql in tables.items()
+        }
+
+
+def measure(name, func, memory):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = ""
+    if memory:
+        peak = f"  peak {tracemalloc.get_traced_memory()[1] / 2 ** 20:8.1f} MB"
+        tracemalloc.stop()
+    print(f"{name:<28} {elapsed:8.3f} s{peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--values", type=int, default=1000000)
+    parser.add_argument("--kpis", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=100)
+    parser.add_argument("--db", help="SQLite file to seed and reuse between runs")
+    parser.add_argument("--memory", action="store_true", help="also report peak traced memory (slower)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = db.create_engine(f"sqlite:///{args.db or os.path.join(tmp, 'bench.db')}")
+        seed(engine, args.categories, args.kpis, args.values)
+        app.engine = engine
+
+        measure("original (4 queries, dicts)", lambda: original_fetch_all_data(engine), args.memory)
+        measure("joined tree, all rows", lambda: app.fetch_all_data(page_size=args.values), args.memory)
+        measure("joined tree, one page", lambda: app.fetch_all_data(), args.memory)
+        measure(
+            "joined tree, filtered page", lambda: app.fetch_all_data({"country": "Japan"}, (args.kpis // 2, 0)),
+            args.memory
+        )
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Compare the original row-by-row insert path with the set-based upserts of
+insert_to_db against local SQLite databases.
+
+Usage:
+    python benchmarks/bench_insert.py --kpis 40 --values 3 --categories 4 --runs 20
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import sqlalchemy as db
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def make_data(kpi_count, value_count):
+    """Build a synthetic extraction result shaped like the Kor output"""
+    return {
+        "category_name": "Gender Pay Gap",
+        "category_description": "Difference in average earnings between women and men",
+        "kpis": [
+            {
+                "kpi_name": f"KPI {k}",
+                "unit": "percentage",
+                "kpi_source": "Synthetic benchmark",
+                "kpi_description": f"Synthetic KPI number {k}",
+                "standard_values": [
+                    {
+                        "geographical_loc": "Australia",
+                        "country": "Australia",
+                        "industry": "Mining",
+                        "gender": "Women vs Men",
+                        "age_group": "All ages",
+                        "experience_level": f"Level {v}",
+                        "value_avg": "12.7",
+                        "value_min": "9.9",
+                        "value_max": "N/A",
+                        "source_val": "Synthetic benchmark"
+                    }
+                    for v in range(value_count)
+                ]
+            }
+            for k in range(kpi_count)
+        ]
+    }
+
+
+def insert_row_by_row(engine, data, selected_categories):
+    """The original insert_to_db loop, with last_insert_rowid() standing in for @@IDENTITY"""
+    with Session(engine) as session:
+        for selected_cat in selected_categories:
+            session.execute(
+                text("INSERT INTO kpis_category (cat_name, cat_description, maincat_id) "
+                     "VALUES (:cat_name, :cat_description, :maincat_id)"),
+                {"cat_name": data["category_name"],
+                 "cat_description": data["category_description"],
+                 "maincat_id": app.category_mapping[selected_cat]}
+            )
+            session.flush()
+            category_id = session.execute(text("SELECT last_insert_rowid()")).scalar()
+            for kpi in data["kpis"]:
+                session.execute(
+                    text("INSERT INTO kpis (category_id, kpi_name, unit, kpi_source, kpi_description) "
+                         "VALUES (:category_id, :kpi_name, :unit, :kpi_source, :kpi_description)"),
+                    {"category_id": category_id, "kpi_name": kpi["kpi_name"], "unit": kpi["unit"],
+                     "kpi_source": kpi["kpi_source"], "kpi_description": kpi["kpi_description"]}
+                )
+                session.flush()
+                kpi_id = session.execute(text("SELECT last_insert_rowid()")).scalar()
+                for std_value in kpi["standard_values"]:
+                    session.execute(
+                        text("INSERT INTO standard_values (kpi_id, geographical_loc, country, industry, "
+                             "gender, age_group, experience_level, value_avg, value_min, value_max, source_val) "
+                             "VALUES (:kpi_id, :geographical_loc, :country, :industry, :gender, :age_group, "
+                             ":experience_level, :value_avg, :value_min, :value_max, :source_val)"),
+                        {**std_value, "kpi_id": kpi_id,
+                         "value_avg": app.parse_number(std_value["value_avg"]),
+                         "value_min": app.parse_number(std_value["value_min"]),
+                         "value_max": app.parse_number(std_value["value_max"])}
+                    )
+        session.commit()
+
+
+def run(name, engine, func, data, categories, runs):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    db.event.listen(engine, "before_cursor_execute", count)
+    start = time.perf_counter()
+    for _ in range(runs):
+        func(data, categories)
+    elapsed = time.perf_counter() - start
+    db.event.remove(engine, "before_cursor_execute", count)
+    print(f"{name:<12} {elapsed / runs * 1000:8.2f} ms/upload  {statements[0] / runs:8.1f} statements/upload")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kpis", type=int, default=40)
+    parser.add_argument("--values", type=int, default=3)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    data = make_data(args.kpis, args.values)
+    categories = list(app.category_mapping)[:args.categories]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The original path adds duplicates on every run, which the unique
+        # natural-key indexes reject, so it gets a database without them
+        legacy_engine = db.create_engine(f"sqlite:///{os.path.join(tmp, 'legacy.db')}")
+        with legacy_engine.begin() as conn:
+            for table in app.metadata.sorted_tables:
+                conn.execute(db.schema.CreateTable(table))
+        engine = db.create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        app.metadata.create_all(engine)
+
+        run("row-by-row", legacy_engine, lambda d, c: insert_row_by_row(legacy_engine, d, c),
+            data, categories, args.runs)
+        run("upsert", engine, lambda d, c: app.insert_to_db(d, c, engine=engine), data, categories, args.runs)
+
+        for name, bench_engine in (("row-by-row", legacy_engine), ("upsert", engine)):
+            with bench_engine.connect() as conn:
+                counts = [
+                    f"{table}={conn.execute(text(f'SELECT COUNT(*) FROM {table}')).scalar()}"
+                    for table in ("kpis_category", "kpis", "standard_values")
+                ]
+            print(f"{name}: {' '.join(counts)}")
+            bench_engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare analysing a long PDF in one Document Intelligence call with
+concurrent page-range calls stitched back together, against the fake
+service with a per-page analysis time.
+
+Also checks that the stitched result yields the same chunks and table rows
+as the single call.
+
+Usage:
+    python benchmarks/bench_page_ranges.py --pages 300 --page-latency 0.02 --range-sizes 0 100 50 25
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+os.environ.update(
+    DOCUMENTINTELLIGENCE_ENDPOINT="http://127.0.0.1:8741",
+    DOCUMENTINTELLIGENCE_API_KEY="fake",
+    DOCUMENTINTELLIGENCE_POLLING_INTERVAL="0.05",
+    DI_CACHE_DIR="",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+import fake_services  # noqa: E402
+
+
+def write_pdf(file_path, page_count):
+    """Minimal PDF skeleton with page_count /Type /Page objects (the fake service ignores the body)"""
+    with open(file_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        for number in range(page_count):
+            f.write(f"{number + 3} 0 obj << /Type /Page /Parent 2 0 R >> endobj\n".encode())
+        f.write(f"2 0 obj << /Type /Pages /Count {page_count} >> endobj\n%%EOF\n".encode())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--page-latency", type=float, default=0.02, help="fake analysis seconds per page")
+    parser.add_argument("--range-sizes", type=int, nargs="+", default=[0, 100, 50, 25], help="0 = one call")
+    parser.add_argument("--fan-out", type=int, default=app.di_range_fan_out)
+    args = parser.parse_args()
+
+    app.di_range_fan_out = args.fan_out
+    # pypdf may be missing and cannot read the skeleton anyway; report its page count
+    app.pdf_page_count = lambda file_path: args.pages
+    app.document_service = app.RateLimitedService("document_intelligence", max(args.fan_out, 1))
+    runner = await fake_services.start_site(
+        fake_services.create_di_app(pages=args.pages, tables=1, page_latency=args.page_latency), 8741
+    )
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "report.pdf")
+            write_pdf(file_path, args.pages)
+            reference = None
+            print(f"{'range size':>10} {'calls':>6} {'seconds':>8}  same output")
+            for size in args.range_sizes:
+                app.di_page_range_size = size
+                start = time.perf_counter()
+                result = await app.analyze_layout(file_path)
+                elapsed = time.perf_counter() - start
+                output = (app.chunk_layout(result), app.table_items(result, source="report.pdf")[0])
+                reference = reference or output
+                calls = len(app.page_ranges(args.pages, size)) if size else 1
+                print(f"{size or 'whole':>10} {calls:>6} {elapsed:>8.2f}  {output == reference}")
+    finally:
+        await app.get_document_client().close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,229 @@
+"""
+Microbenchmark of the in-memory extraction output path.
+
+Compares the previous dict path (json.dumps debug dump of every output,
+nested dict checks, dict-based merge and per-value row dicts with
+convert_to_float_or_none) with the current one (Category/Kpi/StandardValue
+records built in one validation pass, record merge and column batches for
+the writer). Both start from the same raw Kor outputs of several chunks and
+stop at the rows handed to the database writer; no database is involved.
+Reports time per document, peak traced memory and how many of the
+value_avg/min/max strings became numbers.
+
+Usage:
+    python benchmarks/bench_records.py --chunks 8 --categories 4 --kpis 50 --values 6 --runs 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def make_outputs(chunk_count, category_count, kpi_count, value_count):
+    """Raw Kor outputs of chunk_count chunks; neighbouring chunks repeat half of each other's KPIs"""
+    formats = ("{:.1f}%", "${:,.0f}", "{:,.2f}", "N/A")
+    outputs = []
+    for chunk in range(chunk_count):
+        categories = []
+        for c in range(category_count):
+            kpis = []
+            for k in range(chunk * kpi_count // 2, chunk * kpi_count // 2 + kpi_count):
+                kpis.append({
+                    "kpi_name": f"KPI {c}.{k}",
+                    "unit": "percentage",
+                    "kpi_source": "Synthetic report",
+                    "kpi_description": f"Synthetic KPI {c}.{k}",
+                    "standard_values": [
+                        {
+                            "geographical_loc": "Australia",
+                            "country": "Australia",
+                            "industry": "Mining",
+                            "gender": ("Women", "Men")[v % 2],
+                            "age_group": f"{20 + v * 5}-{24 + v * 5}",
+                            "experience_level": "All",
+                            "value_avg": formats[v % 4].format(1234.5 * (k + 1) / (v + 1)),
+                            "value_min": formats[(v + 1) % 4].format(1000.0 + k),
+                            "value_max": "",
+                            "source_val": "Synthetic report",
+                        }
+                        for v in range(value_count)
+                    ],
+                })
+            categories.append({
+                "category_name": f"Category {c}",
+                "category_description": f"Synthetic category {c}",
+                "kpis": kpis,
+            })
+        outputs.append({"data": {"KPI_Category": categories}, "raw": "", "errors": [], "validated_data": {}})
+    return outputs
+
+
+def convert_to_float_or_none(value):
+    """The previous number conversion of insert_to_db"""
+    if value in ['N/A', '', None]:
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def dict_parse(output):
+    """The previous parse_extraction_output, with its debug dump"""
+    json.dumps(output, indent=2)
+    data = output["data"]
+    if isinstance(data, dict):
+        if "KPI_Category" in data:
+            data = data["KPI_Category"]
+        data_to_process = data if isinstance(data, list) else [data]
+    else:
+        data_to_process = [item["KPI_Category"] if "KPI_Category" in item else item for item in data]
+    items = []
+    for item in data_to_process:
+        if not isinstance(item, dict):
+            continue
+        if not all(field in item for field in ["category_name", "category_description", "kpis"]):
+            continue
+        if not isinstance(item["kpis"], list):
+            continue
+        items.append(item)
+    return items
+
+
+def dict_merge(items):
+    """The previous dict-based merge_extractions"""
+    normalize_key = app.normalize_key
+    categories = {}
+    for item in items:
+        category = categories.get(normalize_key(item["category_name"]))
+        if category is None:
+            category = {
+                "category_name": item["category_name"],
+                "category_description": item["category_description"],
+                "kpis": {},
+            }
+            categories[normalize_key(item["category_name"])] = category
+        for kpi in item["kpis"]:
+            if not isinstance(kpi, dict) or "kpi_name" not in kpi:
+                continue
+            merged_kpi = category["kpis"].get(normalize_key(kpi["kpi_name"]))
+            if merged_kpi is None:
+                merged_kpi = {**kpi, "standard_values": [], "_seen_values": set()}
+                category["kpis"][normalize_key(kpi["kpi_name"])] = merged_kpi
+            for std_value in kpi.get("standard_values") or []:
+                if not isinstance(std_value, dict):
+                    continue
+                value_key = tuple(sorted((field, normalize_key(value)) for field, value in std_value.items()))
+                if value_key not in merged_kpi["_seen_values"]:
+                    merged_kpi["_seen_values"].add(value_key)
+                    merged_kpi["standard_values"].append(std_value)
+    merged = []
+    for category in categories.values():
+        kpis = []
+        for kpi in category["kpis"].values():
+            kpi.pop("_seen_values")
+            kpis.append(kpi)
+        merged.append({**category, "kpis": kpis})
+    return merged
+
+
+def dict_rows(item, maincat_ids):
+    """The previous per-value row dicts of insert_to_db, with stand-in ids"""
+    kpi_rows = [
+        {"category_id": maincat_id, "kpi_name": kpi["kpi_name"], "unit": kpi["unit"],
+         "kpi_source": kpi["kpi_source"], "kpi_description": kpi["kpi_description"]}
+        for maincat_id in maincat_ids for kpi in item["kpis"]
+    ]
+    value_rows = [
+        {
+            "kpi_id": index,
+            "geographical_loc": std_value["geographical_loc"],
+            "country": std_value["country"],
+            "industry": std_value["industry"],
+            "gender": std_value["gender"],
+            "age_group": std_value["age_group"],
+            "experience_level": std_value["experience_level"],
+            "value_avg": convert_to_float_or_none(std_value["value_avg"]),
+            "value_min": convert_to_float_or_none(std_value["value_min"]),
+            "value_max": convert_to_float_or_none(std_value["value_max"]),
+            "source_val": std_value["source_val"],
+        }
+        for index, (kpi_row, kpi) in enumerate(zip(kpi_rows, item["kpis"] * len(maincat_ids)))
+        for std_value in kpi.get("standard_values") or []
+    ]
+    return kpi_rows, value_rows
+
+
+def dict_path(outputs, maincat_ids):
+    items = dict_merge([item for output in outputs for item in dict_parse(output)])
+    return [dict_rows(item, maincat_ids) for item in items]
+
+
+def record_batches(item, maincat_ids):
+    """The column batches insert_to_db builds from a Category record, with stand-in ids"""
+    kpis = item.kpis * len(maincat_ids)
+    kpi_batch = {
+        "category_id": [maincat_id for maincat_id in maincat_ids for _ in item.kpis],
+        **app.record_columns(kpis, ("kpi_name", "unit", "kpi_source", "kpi_description")),
+    }
+    value_kpi_ids = []
+    values = []
+    for index, kpi in enumerate(kpis):
+        value_kpi_ids += [index] * len(kpi.standard_values)
+        values += kpi.standard_values
+    return kpi_batch, {"kpi_id": value_kpi_ids, **app.record_columns(values, app.standard_value_fields)}
+
+
+def record_path(outputs, maincat_ids):
+    items = app.merge_extractions([item for output in outputs for item in app.parse_extraction_output(output)])
+    return [record_batches(item, maincat_ids) for item in items]
+
+
+def number_columns(values):
+    """value_avg/min/max of row dicts or of a column batch, flattened"""
+    names = ("value_avg", "value_min", "value_max")
+    if isinstance(values, dict):
+        return [number for name in names for number in values[name]]
+    return [row[name] for row in values for name in names]
+
+
+def measure(func, outputs, maincat_ids, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        func(outputs, maincat_ids)
+    elapsed = (time.perf_counter() - start) / runs
+    tracemalloc.start()
+    result = func(outputs, maincat_ids)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--kpis", type=int, default=50, help="KPIs per category and chunk")
+    parser.add_argument("--values", type=int, default=6, help="standard values per KPI")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    outputs = make_outputs(args.chunks, args.categories, args.kpis, args.values)
+    maincat_ids = [1]
+    app.log = lambda *args: None
+
+    print(f"{'path':<8} {'ms/document':>12} {'peak MB':>9} {'values':>8} {'numbers':>8}")
+    for name, func in (("dicts", dict_path), ("records", record_path)):
+        elapsed, peak, result = measure(func, outputs, maincat_ids, args.runs)
+        numbers = [number for _, values in result for number in number_columns(values)]
+        print(f"{name:<8} {elapsed * 1000:>12.2f} {peak / 2 ** 20:>9.1f} "
+              f"{len(numbers) // 3:>8} {sum(number is not None for number in numbers):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Drive Document Intelligence and Azure OpenAI calls against fake services that
+throttle, and report how many calls succeed, how many 429s the services
+sent and where the adaptive concurrency limits settle.
+
+The first run allows a single attempt per call (the behaviour before retries),
+the second uses the configured retry policy.
+
+Usage:
+    python benchmarks/bench_throttling.py --calls 40 --di-capacity 3 --llm-capacity 4 --llm-throttle "....x"
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+os.environ.update(
+    DOCUMENTINTELLIGENCE_ENDPOINT="http://127.0.0.1:8721",
+    DOCUMENTINTELLIGENCE_API_KEY="fake",
+    DOCUMENTINTELLIGENCE_POLLING_INTERVAL="0.05",
+    AZURE_OPENAI_ENDPOINT="http://127.0.0.1:8722",
+    AZURE_OPENAI_API_KEY="fake",
+    OPENAI_API_VERSION="2024-08-01-preview",
+    DI_CACHE_DIR="",
+    LLM_CACHE_DIR="",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+import fake_services  # noqa: E402
+from bench_extraction import stub_response  # noqa: E402
+
+
+async def run_calls(name, calls, tmp):
+    async def analyze(i):
+        file_path = os.path.join(tmp, f"doc{i}.pdf")
+        with open(file_path, "wb") as f:
+            f.write(f"%PDF-1.4 {name} {i}".encode())
+        await app.analyze_layout(file_path)
+
+    async def extract(i):
+        await app.extract_kpis(f"Document {name} {i}: the gender pay gap is {i % 30}.5%")
+
+    for label, func in (("document_intelligence", analyze), ("llm", extract)):
+        start = time.perf_counter()
+        results = await asyncio.gather(*[func(i) for i in range(calls)], return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        failures = sum(1 for result in results if isinstance(result, Exception))
+        service = app.document_service if label == "document_intelligence" else app.llm_service
+        print(f"{name:<10} {label:<22} {calls - failures:>4}/{calls} ok  {elapsed:7.2f}s  "
+              f"concurrency limit {service.limiter.limit}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=40)
+    parser.add_argument("--di-capacity", type=int, default=3)
+    parser.add_argument("--di-throttle", default="")
+    parser.add_argument("--llm-capacity", type=int, default=4)
+    parser.add_argument("--llm-throttle", default="....x")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per analysis and per completion")
+    parser.add_argument("--retry-after", type=float, default=0.2)
+    args = parser.parse_args()
+
+    app.documentintelligence_polling_interval = 0.05
+    app.retry_base_delay = 0.1
+    app.document_service = app.RateLimitedService("document_intelligence", 8)
+    app.llm_service = app.RateLimitedService("llm", 8)
+
+    di_throttle = fake_services.Throttle(args.di_throttle, args.di_capacity, args.retry_after)
+    llm_throttle = fake_services.Throttle(args.llm_throttle, args.llm_capacity, args.retry_after)
+    runners = [
+        await fake_services.start_site(fake_services.create_di_app(args.latency, pages=1, throttle=di_throttle), 8721),
+        await fake_services.start_site(fake_services.create_llm_app(stub_response(), args.latency, llm_throttle), 8722),
+    ]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            configured_attempts = app.retry_max_attempts
+            for name, attempts in (("no retry", 1), ("retry", configured_attempts)):
+                app.retry_max_attempts = attempts
+                await run_calls(name, args.calls, tmp)
+        print(f"429s sent: document intelligence {di_throttle.throttled}/{di_throttle.requests}, "
+              f"llm {llm_throttle.throttled}/{llm_throttle.requests}")
+    finally:
+        await app.get_document_client().close()
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
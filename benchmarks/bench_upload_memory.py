@@ -0,0 +1,162 @@
+"""
+Measure peak process memory (RSS) of uploads for growing file sizes.
+
+Each measurement runs the app in a fresh server process (hypercorn) and
+streams a multipart upload to it over HTTP, so Quart's request parsing is
+part of what is measured. The upload route (upload_file at /) is measured
+until its job finished (save_upload + analyze_layout stream the file to
+disk and to Document Intelligence). The original path is served as /upload_original: file.save,
+then reading the whole file back and sending it as one bytes body. The
+server reports its peak RSS (resource.getrusage) and the RSS before the
+upload. Runs against the local fake Document Intelligence service and a
+stubbed LLM.
+
+Usage:
+    python benchmarks/bench_upload_memory.py --sizes 8 32 128
+"""
+import os
+import sys
+import asyncio
+import argparse
+import resource
+import tempfile
+
+import aiohttp
+
+DI_PORT = 8711
+APP_PORT = 8712
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def rss_mb():
+    """Peak RSS of this process; ru_maxrss is in KB on Linux and in bytes on macOS"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+async def serve(tmp):
+    """Server process: the app plus the original upload route and a peak RSS report"""
+    os.environ.update(
+        DOCUMENTINTELLIGENCE_ENDPOINT=f"http://127.0.0.1:{DI_PORT}",
+        DOCUMENTINTELLIGENCE_API_KEY="fake",
+        DOCUMENTINTELLIGENCE_POLLING_INTERVAL="0.01",
+        AZURE_OPENAI_ENDPOINT="http://127.0.0.1:1",
+        AZURE_OPENAI_API_KEY="fake",
+        OPENAI_API_VERSION="2024-08-01-preview",
+        DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+        JOB_QUEUE_BACKEND="memory",
+        DI_CACHE_DIR="",
+        LLM_CACHE_DIR="",
+    )
+    import app
+    from bench_extraction import StubChatModel, stub_response
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+    from quart import request, jsonify
+
+    app.app.config['MAX_CONTENT_LENGTH'] = None
+    app.app.config['UPLOAD_FOLDER'] = tmp
+
+    @app.app.before_serving
+    async def stub_llm():
+        app.metadata.create_all(app.get_engine())
+        app.extraction_llm = StubChatModel(latency=0.01, response=stub_response())
+
+    @app.app.route('/upload_original', methods=['POST'])
+    async def upload_original():
+        file = (await request.files)['file']
+        file_path = os.path.join(tmp, "original.pdf")
+        await file.save(file_path)
+        with open(file_path, "rb") as f:
+            file_data = f.read()
+        poller = await app.get_document_client().begin_analyze_document(
+            app.documentintelligence_model, body=file_data, polling_interval=0.01
+        )
+        await poller.result()
+        return jsonify({})
+
+    baseline = rss_mb()
+
+    @app.app.route('/bench_rss')
+    async def bench_rss():
+        return jsonify({"baseline": baseline, "peak": rss_mb()})
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{APP_PORT}"]
+    config.loglevel = "WARNING"
+    await hypercorn_serve(app.app, config)
+
+
+async def upload(session, route, source_path):
+    """Stream source_path as a multipart upload and wait for its job, if any"""
+    with open(source_path, "rb") as source:
+        form = aiohttp.FormData()
+        form.add_field("categories", "Demographic")
+        form.add_field("file", source, filename="report.pdf", content_type="application/pdf")
+        async with session.post(
+            f"http://127.0.0.1:{APP_PORT}{route}", data=form, headers={"Accept": "application/json"}
+        ) as response:
+            body = await response.json()
+            assert response.status < 300, body
+    while "job_id" in body:
+        async with session.get(f"http://127.0.0.1:{APP_PORT}/jobs/{body['job_id']}") as response:
+            job = await response.json()
+        if job["status"] in ("succeeded", "failed"):
+            assert job["status"] == "succeeded", job["error"]
+            return
+        await asyncio.sleep(0.05)
+
+
+async def measure(route, source_path):
+    """Peak RSS minus the RSS before the upload, in a fresh server process"""
+    with tempfile.TemporaryDirectory() as tmp:
+        server = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--serve", tmp, stdout=asyncio.subprocess.DEVNULL
+        )
+        try:
+            async with aiohttp.ClientSession() as session:
+                for _ in range(200):
+                    try:
+                        async with session.get(f"http://127.0.0.1:{APP_PORT}/bench_rss") as response:
+                            await response.read()
+                        break
+                    except aiohttp.ClientConnectionError:
+                        await asyncio.sleep(0.1)
+                await upload(session, route, source_path)
+                async with session.get(f"http://127.0.0.1:{APP_PORT}/bench_rss") as response:
+                    rss = await response.json()
+        finally:
+            server.terminate()
+            await server.wait()
+    return rss["peak"] - rss["baseline"]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8, 32, 128], help="file sizes in MB")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        await serve(args.serve)
+        return
+
+    import fake_services
+    runner = await fake_services.start_site(fake_services.create_di_app(pages=1, tables=1), DI_PORT)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(f"{'size':>8} {'original peak RSS':>18} {'upload_file peak RSS':>21}")
+            for size in args.sizes:
+                source_path = os.path.join(tmp, "source.pdf")
+                with open(source_path, "wb") as f:
+                    for _ in range(size):
+                        f.write(os.urandom(1024 * 1024))
+                original = await measure("/upload_original", source_path)
+                streaming = await measure("/", source_path)
+                print(f"{size:>6}MB {original:>16.1f}MB {streaming:>19.1f}MB")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,302 @@
+"""
+Local stand-ins for the Azure services used by app.py.
+
+The fake Document Intelligence endpoint speaks enough of the REST protocol
+(analyze request, Operation-Location polling, analyzeResult payload) for the
+azure-ai-documentintelligence client to run against it unchanged. The fake
+Azure OpenAI endpoint answers chat completions with a fixed Kor-style reply.
+Both can throttle with 429s on a schedule or above a concurrency capacity.
+
+Usage:
+    python benchmarks/fake_services.py --di-port 8701 --di-latency 2 --llm-port 8702 --llm-throttle "..x" --llm-capacity 4
+
+then point the app at them with
+    DOCUMENTINTELLIGENCE_ENDPOINT=http://127.0.0.1:8701 DOCUMENTINTELLIGENCE_API_KEY=fake
+    AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8702 AZURE_OPENAI_API_KEY=fake OPENAI_API_VERSION=2024-08-01-preview
+"""
+import json
+import uuid
+import asyncio
+import argparse
+import time
+
+from aiohttp import web
+
+
+class Throttle:
+    """
+    Decides which requests are answered with 429 Too Many Requests
+
+    Args:
+        schedule (str): Pattern cycled over incoming requests, "." serves and "x" throttles, e.g. "..x"
+        capacity (int): Requests allowed in flight before further ones are throttled (0 = unlimited)
+        retry_after (float): Seconds sent in the Retry-After header of a 429
+    """
+
+    def __init__(self, schedule="", capacity=0, retry_after=1.0):
+        self.schedule = schedule
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+
+    def check(self, in_flight):
+        """Return a 429 response for this request, or None to serve it"""
+        position = self.requests
+        self.requests += 1
+        scheduled = self.schedule and self.schedule[position % len(self.schedule)] == "x"
+        if scheduled or (self.capacity and in_flight >= self.capacity):
+            self.throttled += 1
+            return web.json_response(
+                {"error": {"code": "429", "message": "Rate limit is exceeded. Try again later."}},
+                status=429, headers={"Retry-After": f"{self.retry_after:g}"}
+            )
+        return None
+
+
+def build_layout(page_count, lines_per_page=30, tables_per_page=0, page_numbers=None):
+    """
+    Build a synthetic prebuilt-layout analyzeResult with page_count pages
+
+    With tables_per_page, each page also gets pay quartile tables (caption,
+    a Women/Men header and four quartile rows) whose lines are part of the
+    page like in real layout results. page_numbers restricts the result to
+    those pages, like the service's pages parameter.
+    """
+    content_parts = []
+    pages = []
+    tables = []
+    offset = 0
+
+    def add_line(lines, line):
+        nonlocal offset
+        span = {"offset": offset, "length": len(line)}
+        lines.append({"content": line, "spans": [span]})
+        content_parts.append(line)
+        offset += len(line) + 1
+        return span
+
+    for page_number in page_numbers or range(1, page_count + 1):
+        page_offset = offset
+        lines = []
+        for line_number in range(lines_per_page):
+            if line_number % 3 == 0:
+                line = f"Average (mean) total remuneration gap {page_number}.{line_number}"
+            elif line_number % 3 == 1:
+                line = f"{(page_number * 7 + line_number) % 30 + 0.5:.1f}%"
+            else:
+                line = f"${(page_number * 1000 + line_number * 37):,}"
+            add_line(lines, line)
+        for table_number in range(tables_per_page):
+            caption = f"Gender composition by pay quartile {page_number}.{table_number}"
+            caption_span = add_line(lines, caption)
+            table_offset = caption_span["offset"]
+            rows = [["Quartile", "Women", "Men"]] + [
+                [quartile, f"{share:.1f}%", f"{100 - share:.1f}%"]
+                for quartile, share in (
+                    ("Upper quartile", 18.5 + table_number), ("Upper middle quartile", 22.0),
+                    ("Lower middle quartile", 27.5), ("Lower quartile", 36.0 - table_number),
+                )
+            ]
+            cells = []
+            for row_index, row in enumerate(rows):
+                for column_index, value in enumerate(row):
+                    span = add_line(lines, value)
+                    cells.append({
+                        "kind": "columnHeader" if row_index == 0 else "content",
+                        "rowIndex": row_index, "columnIndex": column_index,
+                        "content": value, "spans": [span],
+                        "boundingRegions": [{"pageNumber": page_number, "polygon": [0, 0, 1, 0, 1, 1, 0, 1]}],
+                    })
+            tables.append({
+                "rowCount": len(rows), "columnCount": 3, "cells": cells,
+                "caption": {"content": caption, "spans": [caption_span]},
+                "boundingRegions": [{"pageNumber": page_number, "polygon": [0, 0, 1, 0, 1, 1, 0, 1]}],
+                "spans": [{"offset": table_offset, "length": offset - 1 - table_offset}],
+            })
+        pages.append({
+            "pageNumber": page_number,
+            "width": 8.5,
+            "height": 11,
+            "unit": "inch",
+            "lines": lines,
+            "spans": [{"offset": page_offset, "length": offset - page_offset}],
+        })
+    return {
+        "apiVersion": "2024-11-30",
+        "modelId": "prebuilt-layout",
+        "content": "\n".join(content_parts),
+        "pages": pages,
+        "tables": tables,
+        "paragraphs": [],
+    }
+
+
+def parse_pages(pages, page_count):
+    """Page numbers selected by a pages parameter such as "1-3,5", within 1..page_count"""
+    selected = []
+    for part in pages.split(","):
+        first, _, last = part.partition("-")
+        selected += range(int(first), min(int(last or first), page_count) + 1)
+    return selected
+
+
+def create_di_app(latency=0.0, payload=None, pages=3, throttle=None, tables=0, page_latency=0.0):
+    """
+    Create the fake Document Intelligence aiohttp application
+
+    Args:
+        latency (float): Seconds an analysis stays "running" before it succeeds
+        payload (dict): analyzeResult to return, defaults to build_layout(pages)
+        pages (int): Page count of the synthetic default payload
+        throttle (Throttle): Optional 429 policy for analyze requests; running analyses count as in flight
+        tables (int): Tables per page in the synthetic default payload
+        page_latency (float): Extra seconds per analysed page
+
+    The pages query parameter is honoured for the synthetic payload; a fixed
+    payload is returned whole.
+    """
+    operations = {}
+    analyze_result = payload or build_layout(pages, tables_per_page=tables)
+
+    async def analyze(request):
+        # Drain the upload without buffering it
+        async for _ in request.content.iter_chunked(1024 * 1024):
+            pass
+        if throttle:
+            now = time.monotonic()
+            rejected = throttle.check(sum(1 for ready_at, _ in operations.values() if ready_at > now))
+            if rejected:
+                return rejected
+        model_id = request.match_info["model_id"]
+        operation_id = str(uuid.uuid4())
+        result = analyze_result
+        if request.query.get("pages") and not payload:
+            result = build_layout(pages, tables_per_page=tables, page_numbers=parse_pages(request.query["pages"], pages))
+        operations[operation_id] = (time.monotonic() + latency + page_latency * len(result["pages"]), result)
+        location = (
+            f"{request.scheme}://{request.host}/documentintelligence/documentModels/"
+            f"{model_id}/analyzeResults/{operation_id}?api-version={request.query.get('api-version', '')}"
+        )
+        return web.Response(status=202, headers={"Operation-Location": location, "Retry-After": "0"})
+
+    async def analyze_result_status(request):
+        ready_at, result = operations.get(request.match_info["operation_id"], (None, None))
+        if ready_at is None:
+            return web.json_response({"error": {"code": "NotFound", "message": "Unknown operation"}}, status=404)
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        body = {"status": "running", "createdDateTime": now, "lastUpdatedDateTime": now}
+        if time.monotonic() >= ready_at:
+            body.update(status="succeeded", analyzeResult=result)
+        return web.json_response(body)
+
+    di_app = web.Application(client_max_size=1024 ** 3)
+    di_app["throttle"] = throttle
+    di_app.router.add_post(r"/documentintelligence/documentModels/{model_id:[^:/]+}:analyze", analyze)
+    di_app.router.add_get(
+        "/documentintelligence/documentModels/{model_id}/analyzeResults/{operation_id}",
+        analyze_result_status
+    )
+    return di_app
+
+
+def create_llm_app(response_text, latency=0.0, throttle=None):
+    """
+    Create the fake Azure OpenAI aiohttp application
+
+    Args:
+        response_text (str): Assistant message returned for every chat completion
+        latency (float): Seconds each completion takes
+        throttle (Throttle): Optional 429 policy; completions being generated count as in flight
+    """
+    in_flight = [0]
+
+    async def chat_completions(request):
+        body = await request.json()
+        if throttle:
+            rejected = throttle.check(in_flight[0])
+            if rejected:
+                return rejected
+        in_flight[0] += 1
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            in_flight[0] -= 1
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in body.get("messages", [])) // 4
+        completion_tokens = len(response_text) // 4
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.match_info["deployment"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": response_text},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    llm_app = web.Application()
+    llm_app["throttle"] = throttle
+    llm_app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    return llm_app
+
+
+async def start_site(web_app, port):
+    """Start an aiohttp application on 127.0.0.1 and return its runner"""
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def serve(args):
+    payload = None
+    if args.di_payload:
+        with open(args.di_payload) as f:
+            payload = json.load(f)
+    di_throttle = Throttle(args.di_throttle, args.di_capacity, args.retry_after)
+    runners = [await start_site(
+        create_di_app(args.di_latency, payload, args.di_pages, di_throttle, args.di_tables, args.di_page_latency),
+        args.di_port
+    )]
+    print(f"Fake Document Intelligence on http://127.0.0.1:{args.di_port}")
+    if args.llm_port:
+        # The stub reply is derived from the app's schema examples
+        from bench_extraction import stub_response
+        llm_throttle = Throttle(args.llm_throttle, args.llm_capacity, args.retry_after)
+        runners.append(await start_site(create_llm_app(stub_response(), args.llm_latency, llm_throttle), args.llm_port))
+        print(f"Fake Azure OpenAI on http://127.0.0.1:{args.llm_port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--di-port", type=int, default=8701)
+    parser.add_argument("--di-latency", type=float, default=0.0, help="seconds per analysis")
+    parser.add_argument("--di-pages", type=int, default=3, help="pages in the synthetic layout result")
+    parser.add_argument("--di-page-latency", type=float, default=0.0, help="extra seconds per analysed page")
+    parser.add_argument("--di-tables", type=int, default=0, help="pay quartile tables per synthetic page")
+    parser.add_argument("--di-payload", help="JSON file with an analyzeResult to return instead")
+    parser.add_argument("--di-throttle", default="", help='429 schedule cycled per analyze request, e.g. "..x"')
+    parser.add_argument("--di-capacity", type=int, default=0, help="running analyses before 429s (0 = unlimited)")
+    parser.add_argument("--llm-port", type=int, help="also serve a fake Azure OpenAI endpoint on this port")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per completion")
+    parser.add_argument("--llm-throttle", default="", help='429 schedule cycled per completion request, e.g. "..x"')
+    parser.add_argument("--llm-capacity", type=int, default=0, help="completions in flight before 429s (0 = unlimited)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    args = parser.parse_args()
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
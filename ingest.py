@@ -0,0 +1,141 @@
+"""
+Batch ingestion of documents from the command line.
+
+Runs every file through the same analyze -> extract -> store pipeline as
+uploads, with separate worker counts per stage. Finished files are
+recorded in a checkpoint file, so an interrupted run can simply be
+started again and skips what is already stored.
+
+Usage:
+    python ingest.py reports/ extra.pdf --categories "Salary Information" "Demographic"
+    python ingest.py reports/ --analyze-workers 4 --extract-workers 8 --store-workers 2
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import mimetypes
+
+import app as kpi_app
+
+
+def find_files(paths):
+    """Expand files and directories (recursively) into supported document paths"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    file_path = os.path.join(root, name)
+                    if mimetypes.guess_type(file_path)[0]:
+                        yield file_path
+        elif os.path.isfile(path):
+            yield path
+        else:
+            print(f"Skipping missing path: {path}")
+
+
+def load_checkpoint(checkpoint_path):
+    """Hashes of files stored by earlier runs"""
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["file_hash"])
+                except (ValueError, KeyError):
+                    continue
+    return done
+
+
+async def ingest(args):
+    kpi_app.job_queue_backend = "memory"
+    kpi_app.job_stage_workers.update(
+        analyze=args.analyze_workers,
+        extract=args.extract_workers,
+        store=args.store_workers,
+    )
+
+    done = load_checkpoint(args.checkpoint)
+    await kpi_app.startup()
+    try:
+        jobs = []
+        skipped = 0
+        for file_path in find_files(args.paths):
+            file_hash = await asyncio.to_thread(kpi_app.hash_file, file_path)
+            if file_hash in done:
+                skipped += 1
+                continue
+            done.add(file_hash)
+            # Files are revisions of the document stored under the same path
+            job = kpi_app.create_job(
+                file_path, os.path.basename(file_path), args.categories, file_hash, os.path.normpath(file_path)
+            )
+            await kpi_app.enqueue_job(job)
+            jobs.append(job)
+        print(f"Queued {len(jobs)} files, skipped {skipped} already in {args.checkpoint}")
+
+        start = time.perf_counter()
+        pending = list(jobs)
+        with open(args.checkpoint, "a") as checkpoint:
+            while pending:
+                await asyncio.sleep(0.2)
+                still_pending = []
+                for job in pending:
+                    if job["status"] == "succeeded":
+                        checkpoint.write(json.dumps({"file_hash": job["file_hash"], "path": job["file_path"]}) + "\n")
+                        checkpoint.flush()
+                        print(f"Stored {job['file_path']}")
+                    elif job["status"] == "failed":
+                        print(f"Failed {job['file_path']}: {job['error']}")
+                    else:
+                        still_pending.append(job)
+                pending = still_pending
+        elapsed = time.perf_counter() - start
+    finally:
+        await kpi_app.shutdown()
+
+    report(jobs, elapsed)
+
+
+def report(jobs, elapsed):
+    """Print throughput and the time spent per stage"""
+    succeeded = sum(1 for job in jobs if job["status"] == "succeeded")
+    print(f"\n{succeeded}/{len(jobs)} files stored in {elapsed:.1f}s", end="")
+    print(f" ({succeeded / elapsed * 60:.1f} files/min)" if elapsed and succeeded else "")
+
+    print(f"{'stage':<10} {'files':>6} {'total s':>10} {'mean s':>10} {'max s':>10}")
+    for stage in kpi_app.job_stages:
+        durations = [
+            job["stages"][stage]["finished"] - job["stages"][stage]["started"]
+            for job in jobs
+            if job["stages"][stage]["started"] and job["stages"][stage]["finished"]
+        ]
+        if durations:
+            print(f"{stage:<10} {len(durations):>6} {sum(durations):>10.2f} "
+                  f"{sum(durations) / len(durations):>10.2f} {max(durations):>10.2f}")
+
+    reports = [job["tokens"] for job in jobs if job.get("tokens")]
+    if reports:
+        totals = {name: sum(report[name] for report in reports) for name in reports[0]}
+        print(f"LLM calls {totals['calls']}, prompt tokens {totals['prompt_tokens']} "
+              f"(~{totals['example_tokens']} examples), completion tokens {totals['completion_tokens']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="files or directories to ingest")
+    parser.add_argument(
+        "--categories", nargs="+", default=list(kpi_app.category_mapping),
+        choices=list(kpi_app.category_mapping), help="main categories to store the KPIs under (default: all)"
+    )
+    parser.add_argument("--analyze-workers", type=int, default=kpi_app.job_stage_workers["analyze"])
+    parser.add_argument("--extract-workers", type=int, default=kpi_app.job_stage_workers["extract"])
+    parser.add_argument("--store-workers", type=int, default=kpi_app.job_stage_workers["store"])
+    parser.add_argument("--checkpoint", default="ingest_checkpoint.jsonl", help="file recording finished documents")
+    args = parser.parse_args()
+    asyncio.run(ingest(args))
+
+
+if __name__ == "__main__":
+    main()